@@ -5,11 +5,23 @@ REST API for AI image/video generation and editing
 
 import os
 import io
+import re
+import sys
+import gzip
+import json
+import random
 import base64
-import sqlite3
+import hashlib
+import mimetypes
 import tempfile
 import time
 import uuid
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
 from functools import wraps
 from pathlib import Path
@@ -18,11 +30,15 @@ import yaml
 import requests
 import cv2
 import numpy as np
-from PIL import Image
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from PIL import Image, UnidentifiedImageError, features
+from flask import Flask, request, jsonify, send_file, send_from_directory, g, has_request_context, make_response
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
 
 # Google Generative AI
@@ -32,6 +48,12 @@ import google.generativeai as genai
 from huggingface_hub import InferenceClient
 from gradio_client import Client, handle_file
 
+# Brotli is optional; responses fall back to gzip without it
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # ============================================================================
 # APP CONFIGURATION
 # ============================================================================
@@ -59,13 +81,53 @@ jwt = JWTManager(app)
 os.makedirs('database', exist_ok=True)
 os.makedirs('uploads', exist_ok=True)
 os.makedirs('outputs', exist_ok=True)
+os.makedirs('outputs/variants', exist_ok=True)
 
 DATABASE_PATH = 'database/users.db'
 
+# Local SQLite file by default; set DATABASE_URL (e.g. postgresql://...) to share
+# one database between several instances. Use "sqlite://" for an in-memory database.
+DATABASE_URL = os.getenv('DATABASE_URL') or f"sqlite:///{os.path.abspath(DATABASE_PATH)}"
+if DATABASE_URL.startswith('postgres://'):
+    DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://', 1)
+
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+if DATABASE_URL.startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"connect_args": {"timeout": 30}}
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        "pool_size": int(os.getenv('DB_POOL_SIZE', 5)),
+        "max_overflow": int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+
+db = SQLAlchemy(app)
+VARIANT_FOLDER = 'outputs/variants'
+ASSET_BUILD_FOLDER = 'build/assets'
+
 # Free user limits
 FREE_IMAGE_LIMIT = 3
 FREE_VIDEO_LIMIT = 3
 
+# Credits charged per generation
+CREDIT_COST = 1.0
+
+# Credit and usage holds not committed or released within this window are released by the reconciler
+CREDIT_HOLD_TIMEOUT = 30 * 60
+
+# Seconds between credit reconciliation runs
+CREDIT_RECONCILE_INTERVAL = 60
+
+# Stored Idempotency-Key responses are kept this long (seconds)
+IDEMPOTENCY_TTL = 24 * 3600
+
+# How long a retry waits for the original request to finish before giving up
+IDEMPOTENCY_WAIT_TIMEOUT = 300
+
+# An in-progress key older than this is treated as abandoned (the worker died)
+IDEMPOTENCY_LOCK_TIMEOUT = 30 * 60
+
 # Credit packages
 CREDIT_PACKAGES = {
     "basic": {"price": 22, "credits": 1000, "name": "Basic"},
@@ -77,57 +139,154 @@ CREDIT_PACKAGES = {
 # DATABASE FUNCTIONS
 # ============================================================================
 
+users_table = db.Table(
+    'users',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('email', db.String(255), unique=True, nullable=False),
+    db.Column('password_hash', db.String(255), nullable=False),
+    db.Column('is_premium', db.Integer, server_default='0'),
+    db.Column('credits', db.Float, server_default='0'),
+    db.Column('created_at', db.DateTime, server_default=func.current_timestamp()),
+    sqlite_autoincrement=True,
+)
+
+usage_table = db.Table(
+    'usage',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('users.id')),
+    db.Column('feature', db.String(50), nullable=False),
+    db.Column('usage_date', db.Date, nullable=False),
+    db.Column('count', db.Integer, server_default='1'),
+    db.UniqueConstraint('user_id', 'feature', 'usage_date'),
+    sqlite_autoincrement=True,
+)
+
+transactions_table = db.Table(
+    'transactions',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('users.id')),
+    db.Column('package', db.String(50), nullable=False),
+    db.Column('amount', db.Float, nullable=False),
+    db.Column('credits', db.Integer, nullable=False),
+    db.Column('created_at', db.DateTime, server_default=func.current_timestamp()),
+    sqlite_autoincrement=True,
+)
+
+credit_holds_table = db.Table(
+    'credit_holds',
+    db.Column('id', db.String(32), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('users.id'), nullable=False),
+    db.Column('amount', db.Float, nullable=False),
+    db.Column('status', db.String(20), nullable=False, server_default='held'),
+    db.Column('expires_at', db.Float, nullable=False),
+    db.Column('created_at', db.DateTime, server_default=func.current_timestamp()),
+    db.Index('ix_credit_holds_status_expires', 'status', 'expires_at'),
+)
+
+# Append-only: the sum of a user's entries is their spendable balance
+credit_ledger_table = db.Table(
+    'credit_ledger',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('users.id'), nullable=False),
+    db.Column('hold_id', db.String(32)),
+    db.Column('entry_type', db.String(20), nullable=False),
+    db.Column('amount', db.Float, nullable=False),
+    db.Column('created_at', db.DateTime, server_default=func.current_timestamp()),
+    db.Index('ix_credit_ledger_user_id', 'user_id'),
+    sqlite_autoincrement=True,
+)
+
+# Free-tier uses reserved from the daily limit, so abandoned ones can be given back
+usage_holds_table = db.Table(
+    'usage_holds',
+    db.Column('id', db.String(32), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('users.id'), nullable=False),
+    db.Column('feature', db.String(50), nullable=False),
+    db.Column('usage_date', db.Date, nullable=False),
+    db.Column('status', db.String(20), nullable=False, server_default='held'),
+    db.Column('expires_at', db.Float, nullable=False),
+    db.Column('created_at', db.DateTime, server_default=func.current_timestamp()),
+    db.Index('ix_usage_holds_status_expires', 'status', 'expires_at'),
+)
+
+idempotency_keys_table = db.Table(
+    'idempotency_keys',
+    db.Column('user_id', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('idempotency_key', db.String(255), primary_key=True),
+    db.Column('fingerprint', db.String(64), nullable=False),
+    db.Column('status', db.String(20), nullable=False, server_default='in_progress'),
+    db.Column('response_status', db.Integer),
+    db.Column('response_body', db.Text),
+    db.Column('inline_field', db.String(20)),
+    db.Column('started_at', db.Float, nullable=False),
+    db.Column('expires_at', db.Float, nullable=False),
+    db.Index('ix_idempotency_keys_expires_at', 'expires_at'),
+)
+
+schema_migrations_table = db.Table(
+    'schema_migrations',
+    db.Column('version', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('applied_at', db.DateTime, server_default=func.current_timestamp()),
+)
+
 def get_db():
-    """Get database connection."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Get a pooled connection in a transaction that commits when the block exits."""
+    return db.engine.begin()
+
+def migration_initial_schema(conn):
+    """Create users, usage and transactions tables (kept for existing users.db files)."""
+    db.metadata.create_all(conn, tables=[users_table, usage_table, transactions_table])
+
+def migration_credit_ledger(conn):
+    """Create the credit ledger and seed it with each user's current balance."""
+    db.metadata.create_all(conn, tables=[credit_holds_table, credit_ledger_table])
+    conn.execute(text('''
+        INSERT INTO credit_ledger (user_id, entry_type, amount)
+        SELECT id, 'opening', credits FROM users WHERE credits <> 0
+    '''))
+
+def migration_idempotency_keys(conn):
+    """Create the table storing responses for Idempotency-Key replays."""
+    db.metadata.create_all(conn, tables=[idempotency_keys_table])
+
+def migration_usage_holds(conn):
+    """Create the table tracking free-tier usage reservations."""
+    db.metadata.create_all(conn, tables=[usage_holds_table])
+
+# Schema migrations, applied in order. Append new ones; never edit an applied one.
+MIGRATIONS = [
+    (1, migration_initial_schema),
+    (2, migration_credit_ledger),
+    (3, migration_idempotency_keys),
+    (4, migration_usage_holds),
+]
 
 def init_database():
-    """Initialize SQLite database."""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            is_premium INTEGER DEFAULT 0,
-            credits REAL DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS usage (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            feature TEXT NOT NULL,
-            usage_date DATE NOT NULL,
-            count INTEGER DEFAULT 1,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            UNIQUE(user_id, feature, usage_date)
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            package TEXT NOT NULL,
-            amount REAL NOT NULL,
-            credits INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
+    """Create the schema and apply pending migrations."""
+    if db.engine.dialect.name == 'sqlite' and db.engine.url.database not in (None, '', ':memory:'):
+        # WAL lets readers proceed while another worker holds the write lock
+        @event.listens_for(db.engine, "connect")
+        def set_sqlite_wal(dbapi_conn, connection_record):
+            dbapi_conn.execute("PRAGMA journal_mode = WAL")
     
-    conn.commit()
-    conn.close()
+    try:
+        with get_db() as conn:
+            schema_migrations_table.create(conn, checkfirst=True)
+            applied = set(conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+            for version, migrate in MIGRATIONS:
+                if version not in applied:
+                    migrate(conn)
+                    conn.execute(
+                        text("INSERT INTO schema_migrations (version) VALUES (:version)"),
+                        {"version": version}
+                    )
+    except IntegrityError:
+        # Another instance applied the same migration concurrently
+        pass
 
 # Initialize database on startup
-init_database()
+with app.app_context():
+    init_database()
 
 # ============================================================================
 # API CONFIGURATION
@@ -170,70 +329,954 @@ def get_hf_client(token=None):
 
 def get_user_by_id(user_id):
     """Get user by ID."""
-    conn = get_db()
-    user = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-    conn.close()
+    with get_db() as conn:
+        user = conn.execute(
+            text("SELECT * FROM users WHERE id = :user_id"),
+            {"user_id": user_id}
+        ).mappings().first()
     return dict(user) if user else None
 
 def get_user_usage(user_id, feature):
     """Get today's usage count for a feature."""
-    conn = get_db()
     today = date.today().isoformat()
-    result = conn.execute(
-        "SELECT count FROM usage WHERE user_id = ? AND feature = ? AND usage_date = ?",
-        (user_id, feature, today)
-    ).fetchone()
-    conn.close()
+    with get_db() as conn:
+        result = conn.execute(
+            text("SELECT count FROM usage WHERE user_id = :user_id AND feature = :feature AND usage_date = :today"),
+            {"user_id": user_id, "feature": feature, "today": today}
+        ).mappings().first()
     return result['count'] if result else 0
 
-def increment_usage(user_id, feature):
-    """Increment usage count for a feature."""
-    conn = get_db()
+def increment_usage(user_id, feature, limit, hold_id=None):
+    """Increment today's usage count for a feature unless it has reached the limit.
+    
+    With a hold_id, the use is also recorded as a usage hold in the same
+    transaction, so a failed or abandoned request can give it back.
+    """
     today = date.today().isoformat()
-    conn.execute('''
-        INSERT INTO usage (user_id, feature, usage_date, count)
-        VALUES (?, ?, ?, 1)
-        ON CONFLICT(user_id, feature, usage_date) 
-        DO UPDATE SET count = count + 1
-    ''', (user_id, feature, today))
-    conn.commit()
-    conn.close()
-
-def deduct_credits(user_id, amount=1.0):
-    """Deduct credits from user account."""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE users SET credits = credits - ? WHERE id = ? AND credits >= ?",
-        (amount, user_id, amount)
+    with get_db() as conn:
+        result = conn.execute(text('''
+            INSERT INTO usage (user_id, feature, usage_date, count)
+            VALUES (:user_id, :feature, :today, 1)
+            ON CONFLICT(user_id, feature, usage_date) 
+            DO UPDATE SET count = usage.count + 1 WHERE usage.count < :limit
+        '''), {"user_id": user_id, "feature": feature, "today": today, "limit": limit})
+        if result.rowcount == 0:
+            return False
+        
+        if hold_id:
+            conn.execute(
+                text('''
+                    INSERT INTO usage_holds (id, user_id, feature, usage_date, status, expires_at)
+                    VALUES (:hold_id, :user_id, :feature, :today, 'held', :expires_at)
+                '''),
+                {"hold_id": hold_id, "user_id": user_id, "feature": feature, "today": today,
+                 "expires_at": time.time() + CREDIT_HOLD_TIMEOUT}
+            )
+    return True
+
+def commit_usage_hold(hold_id):
+    """Keep a free-tier use after a successful generation."""
+    with get_db() as conn:
+        result = conn.execute(
+            text("UPDATE usage_holds SET status = 'committed' WHERE id = :hold_id AND status = 'held'"),
+            {"hold_id": hold_id}
+        )
+        return result.rowcount > 0
+
+def release_usage_hold(hold_id):
+    """Give a free-tier use back to the day it was taken from."""
+    with get_db() as conn:
+        result = conn.execute(
+            text("UPDATE usage_holds SET status = 'released' WHERE id = :hold_id AND status = 'held'"),
+            {"hold_id": hold_id}
+        )
+        if result.rowcount == 0:
+            return False
+        
+        hold = conn.execute(
+            text("SELECT user_id, feature, usage_date FROM usage_holds WHERE id = :hold_id"),
+            {"hold_id": hold_id}
+        ).mappings().first()
+        conn.execute(
+            text('''
+                UPDATE usage SET count = count - 1
+                WHERE user_id = :user_id AND feature = :feature AND usage_date = :usage_date AND count > 0
+            '''),
+            {"user_id": hold['user_id'], "feature": hold['feature'], "usage_date": str(hold['usage_date'])}
+        )
+    return True
+
+def add_ledger_entry(conn, user_id, entry_type, amount, hold_id=None):
+    """Append a credit ledger entry inside the caller's transaction."""
+    conn.execute(
+        text("INSERT INTO credit_ledger (user_id, hold_id, entry_type, amount) VALUES (:user_id, :hold_id, :entry_type, :amount)"),
+        {"user_id": user_id, "hold_id": hold_id, "entry_type": entry_type, "amount": amount}
     )
-    success = cursor.rowcount > 0
-    conn.commit()
-    conn.close()
-    return success
 
-def check_usage_limit(user_id, feature, limit):
-    """Check if user can use a feature."""
+def hold_credits(user_id, amount=CREDIT_COST):
+    """Atomically reserve credits. Returns a hold ID, or None if the balance is too low."""
+    hold_id = uuid.uuid4().hex
+    with get_db() as conn:
+        result = conn.execute(
+            text("UPDATE users SET credits = credits - :amount WHERE id = :user_id AND credits >= :amount"),
+            {"amount": amount, "user_id": user_id}
+        )
+        if result.rowcount == 0:
+            return None
+        
+        conn.execute(
+            text("INSERT INTO credit_holds (id, user_id, amount, status, expires_at) VALUES (:hold_id, :user_id, :amount, 'held', :expires_at)"),
+            {"hold_id": hold_id, "user_id": user_id, "amount": amount, "expires_at": time.time() + CREDIT_HOLD_TIMEOUT}
+        )
+        add_ledger_entry(conn, user_id, 'hold', -amount, hold_id)
+    return hold_id
+
+def commit_credits(hold_id):
+    """Finalize a hold after a successful generation.
+    
+    The 'hold' ledger entry already carries the debit, so this only flips the
+    hold's status: no user row update and no ledger write.
+    """
+    with get_db() as conn:
+        result = conn.execute(
+            text("UPDATE credit_holds SET status = 'committed' WHERE id = :hold_id AND status = 'held'"),
+            {"hold_id": hold_id}
+        )
+        return result.rowcount > 0
+
+def release_credits(hold_id):
+    """Return held credits to the user after a failed or timed-out generation."""
+    with get_db() as conn:
+        result = conn.execute(
+            text("UPDATE credit_holds SET status = 'released' WHERE id = :hold_id AND status = 'held'"),
+            {"hold_id": hold_id}
+        )
+        if result.rowcount == 0:
+            return False
+        
+        hold = conn.execute(
+            text("SELECT user_id, amount FROM credit_holds WHERE id = :hold_id"),
+            {"hold_id": hold_id}
+        ).mappings().first()
+        conn.execute(
+            text("UPDATE users SET credits = credits + :amount WHERE id = :user_id"),
+            {"amount": hold['amount'], "user_id": hold['user_id']}
+        )
+        add_ledger_entry(conn, hold['user_id'], 'release', hold['amount'], hold_id)
+    return True
+
+def reconcile_credits():
+    """Release expired holds and re-derive materialized balances from the ledger."""
+    now = time.time()
+    with get_db() as conn:
+        expired_credit_holds = conn.execute(
+            text("SELECT id FROM credit_holds WHERE status = 'held' AND expires_at < :now"),
+            {"now": now}
+        ).scalars().all()
+        expired_usage_holds = conn.execute(
+            text("SELECT id FROM usage_holds WHERE status = 'held' AND expires_at < :now"),
+            {"now": now}
+        ).scalars().all()
+    
+    released = sum(1 for hold_id in expired_credit_holds if release_credits(hold_id))
+    released += sum(1 for hold_id in expired_usage_holds if release_usage_hold(hold_id))
+    
+    # Balance and ledger sum come from one statement, so they are a consistent pair
+    with get_db() as conn:
+        drifted = conn.execute(text('''
+            SELECT id, credits, balance FROM (
+                SELECT id, credits, (
+                    SELECT COALESCE(SUM(amount), 0) FROM credit_ledger WHERE credit_ledger.user_id = users.id
+                ) AS balance
+                FROM users
+            ) AS balances
+            WHERE credits <> balance
+        ''')).mappings().all()
+    
+    corrected = 0
+    for row in drifted:
+        # Only overwrite the balance we read; if a hold or purchase changed it
+        # meanwhile, skip the user until the next run instead of clobbering it
+        with get_db() as conn:
+            result = conn.execute(
+                text("UPDATE users SET credits = :balance WHERE id = :user_id AND credits = :credits"),
+                {"balance": row['balance'], "user_id": row['id'], "credits": row['credits']}
+            )
+            corrected += result.rowcount
+    
+    if released or corrected:
+        print(f"Credit reconciliation: released {released} expired holds, corrected {corrected} balances")
+    return released, corrected
+
+def run_credit_reconciler():
+    """Run reconcile_credits (and the expired Idempotency-Key purge) every CREDIT_RECONCILE_INTERVAL.
+    
+    Needs to run in exactly one process per deployment, so it is not started on
+    import: `python app.py` starts it on a thread, and deployments with several
+    workers run `flask --app app reconcile-credits` once alongside them.
+    """
+    while True:
+        try:
+            with app.app_context():
+                reconcile_credits()
+        except Exception as e:
+            print(f"Credit reconciliation failed: {e}")
+        try:
+            with app.app_context():
+                purge_idempotency_keys()
+        except Exception as e:
+            print(f"Idempotency key purge failed: {e}")
+        time.sleep(CREDIT_RECONCILE_INTERVAL)
+
+def start_credit_reconciler():
+    """Run the credit reconciler on a background thread."""
+    threading.Thread(target=run_credit_reconciler, name='credit-reconciler', daemon=True).start()
+
+@app.cli.command('reconcile-credits')
+def reconcile_credits_command():
+    """Run the credit reconciler in the foreground."""
+    run_credit_reconciler()
+
+def reserve_usage(user_id, feature, limit):
+    """Reserve one use of a feature before calling the upstream.
+    
+    Paying users get a credit hold; everyone else takes a slot from the daily
+    free limit. Returns (hold, error); pass the hold to commit_usage on success
+    or release_usage on failure.
+    """
     user = get_user_by_id(user_id)
     if not user:
-        return False, "User not found"
+        return None, "User not found"
     
-    if user['credits'] > 0:
-        return True, None
+    if user['credits'] >= CREDIT_COST:
+        hold_id = hold_credits(user_id, CREDIT_COST)
+        if hold_id:
+            return {"type": "credits", "id": hold_id}, None
     
-    usage = get_user_usage(user_id, feature)
-    if usage >= limit:
-        return False, f"Daily limit reached ({limit}). Upgrade to premium for unlimited access!"
+    hold_id = uuid.uuid4().hex
+    if increment_usage(user_id, feature, limit, hold_id):
+        return {"type": "usage", "id": hold_id}, None
     
-    return True, None
+    return None, f"Daily limit reached ({limit}). Upgrade to premium for unlimited access!"
 
-def consume_usage(user_id, feature):
-    """Record usage for a feature."""
-    user = get_user_by_id(user_id)
-    if user['credits'] > 0:
-        deduct_credits(user_id, 1.0)
+def commit_usage(hold):
+    """Keep a reservation once the generation succeeded."""
+    if hold['type'] == 'credits':
+        commit_credits(hold['id'])
+    else:
+        commit_usage_hold(hold['id'])
+
+def release_usage(hold):
+    """Undo a reservation after the generation failed."""
+    if hold['type'] == 'credits':
+        release_credits(hold['id'])
     else:
-        increment_usage(user_id, feature)
+        release_usage_hold(hold['id'])
+
+# ============================================================================
+# IMAGE VARIANTS
+# ============================================================================
+
+# Resized variants of generated images (max edge in px, None = original size)
+IMAGE_VARIANTS = {
+    "thumb": 256,
+    "preview": 1024,
+    "full": None,
+}
+
+# Encodings in order of preference: (mimetype, PIL format, extension, save options)
+IMAGE_ENCODINGS = [
+    ("image/avif", "AVIF", "avif", {"quality": 60}),
+    ("image/webp", "WEBP", "webp", {"quality": 80, "method": 4}),
+    ("image/png", "PNG", "png", {"optimize": True}),
+]
+
+# Output filenames are unique, so variants can be cached for a long time
+IMAGE_VARIANT_MAX_AGE = 365 * 24 * 3600
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp'}
+
+def encoding_available(pil_format):
+    """Check whether Pillow was built with an encoder for a format."""
+    if pil_format == "PNG":
+        return True
+    return features.check(pil_format.lower())
+
+AVAILABLE_IMAGE_ENCODINGS = [e for e in IMAGE_ENCODINGS if encoding_available(e[1])]
+
+def is_image_output(filename):
+    """Check if an output file is an image we can build variants for."""
+    return os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS
+
+def negotiate_image_encoding(accept_mimetypes):
+    """Pick the encoding the client lists with the highest q-value, falling back to PNG.
+    
+    Only mimetypes named explicitly count: */* and image/* are sent by browsers and
+    HTTP libraries that can't necessarily display AVIF or WebP. Ties between listed
+    encodings go to the smaller format.
+    """
+    listed = {}
+    for value, quality in accept_mimetypes:
+        listed.setdefault(value.lower(), quality)
+    
+    best = None
+    for encoding in AVAILABLE_IMAGE_ENCODINGS:
+        quality = listed.get(encoding[0], 0)
+        if quality > 0 and (best is None or quality > best[0]):
+            best = (quality, encoding)
+    return best[1] if best else AVAILABLE_IMAGE_ENCODINGS[-1]
+
+def get_image_variant(filename, variant, encoding):
+    """Return the path of an image variant, rendering it into the cache on first use."""
+    source_path = os.path.join('outputs', filename)
+    mimetype, pil_format, ext, options = encoding
+    max_edge = IMAGE_VARIANTS[variant]
+    
+    if max_edge is None and filename.lower().endswith(f".{ext}"):
+        return source_path
+    
+    stem = os.path.splitext(filename)[0]
+    variant_path = os.path.join(VARIANT_FOLDER, f"{stem}_{variant}.{ext}")
+    if os.path.exists(variant_path) and os.path.getmtime(variant_path) >= os.path.getmtime(source_path):
+        return variant_path
+    
+    try:
+        image = Image.open(source_path)
+        image.load()
+    except OSError as e:
+        # Unknown formats and truncated files alike
+        raise UnidentifiedImageError(f"Cannot decode {filename}") from e
+    
+    with image:
+        if max_edge:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if image.mode not in ("RGB", "RGBA"):
+            has_alpha = image.mode in ("LA", "PA") or "transparency" in image.info
+            image = image.convert("RGBA" if has_alpha else "RGB")
+        
+        # Write to a temp file first so concurrent requests never see a partial image
+        temp_path = f"{variant_path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            image.save(temp_path, format=pil_format, **options)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    os.replace(temp_path, variant_path)
+    return variant_path
+
+@app.errorhandler(UnidentifiedImageError)
+def handle_undecodable_image(e):
+    """Answer with JSON when an output can't be decoded to build a variant."""
+    return jsonify({"error": "Image could not be decoded"}), 415
+
+def variant_urls(filename):
+    """Build URLs for every size variant of a generated image."""
+    return {name: f"/api/image/{filename}/{name}" for name in IMAGE_VARIANTS}
+
+def wants_inline_output():
+    """Check if the client wants base64 output inline in the JSON response."""
+    return request.args.get('inline', '1') != '0'
+
+# ============================================================================
+# STATIC ASSETS & COMPRESSION
+# ============================================================================
+
+# Static files that get fingerprinted and precompressed at startup
+ASSET_EXTENSIONS = {'.css', '.js'}
+
+# Fingerprinted assets never change, so clients may cache them forever
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+# Precompressed sibling files, in order of preference
+PRECOMPRESSED_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+# API responses smaller than this are sent uncompressed
+COMPRESSION_MIN_SIZE = 1024
+
+# ...and so are larger ones: past this size the body is mostly an inline base64
+# image or video, which barely compresses and would tie up the request thread
+COMPRESSION_MAX_SIZE = 1024 * 1024
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/javascript',
+    'text/html',
+    'text/css',
+    'text/plain',
+}
+
+def available_encodings():
+    """Content encodings this server can produce, in order of preference."""
+    return ["br", "gzip"] if brotli else ["gzip"]
+
+def compress_data(data, encoding, static=False):
+    """Compress data; static assets get the slow, maximum-ratio settings."""
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if static else 4)
+    return gzip.compress(data, compresslevel=9 if static else 6, mtime=0)
+
+def choose_content_encoding(encodings):
+    """Pick the first of the given encodings the client accepts."""
+    for encoding in encodings:
+        if request.accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+def write_file_atomic(path, data):
+    """Write a file via rename so concurrent workers never read a partial file."""
+    temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def build_static_assets():
+    """Fingerprint and precompress static assets, returning a name -> URL manifest."""
+    os.makedirs(ASSET_BUILD_FOLDER, exist_ok=True)
+    manifest = {}
+    
+    for name in sorted(os.listdir('static')):
+        stem, ext = os.path.splitext(name)
+        if ext not in ASSET_EXTENSIONS:
+            continue
+        
+        with open(os.path.join('static', name), 'rb') as f:
+            data = f.read()
+        
+        hashed_name = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+        path = os.path.join(ASSET_BUILD_FOLDER, hashed_name)
+        if not os.path.exists(path):
+            # Compressed siblings first, so the plain file marks a complete build
+            for encoding in available_encodings():
+                write_file_atomic(path + PRECOMPRESSED_SUFFIXES[encoding], compress_data(data, encoding, static=True))
+            write_file_atomic(path, data)
+        
+        manifest[name] = f"/assets/{hashed_name}"
+    
+    return manifest
+
+def build_index_page(manifest):
+    """Rewrite asset references in index.html and precompress the result."""
+    with open(os.path.join('static', 'index.html'), 'rb') as f:
+        html = f.read().decode('utf-8')
+    
+    def replace_reference(match):
+        url = manifest.get(match.group(2))
+        return f'{match.group(1)}="{url}"' if url else match.group(0)
+    
+    html = re.sub(r'(href|src)="/static/([^"?]+)(\?[^"]*)?"', replace_reference, html)
+    data = html.encode('utf-8')
+    
+    page = {"etag": hashlib.sha256(data).hexdigest()[:16], "identity": data}
+    for encoding in available_encodings():
+        page[encoding] = compress_data(data, encoding, static=True)
+    return page
+
+# Build assets on startup
+ASSET_MANIFEST = build_static_assets()
+INDEX_PAGE = build_index_page(ASSET_MANIFEST)
+
+@app.after_request
+def compress_response(response):
+    """Compress large API responses with the best encoding the client accepts."""
+    if (
+        not request.path.startswith('/api/')
+        or response.direct_passthrough
+        or response.is_streamed
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+        or not 200 <= response.status_code < 300
+    ):
+        return response
+    
+    data = response.get_data()
+    if not COMPRESSION_MIN_SIZE <= len(data) <= COMPRESSION_MAX_SIZE:
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    encoding = choose_content_encoding(available_encodings())
+    if encoding:
+        response.set_data(compress_data(data, encoding))
+        response.content_encoding = encoding
+    return response
+
+# ============================================================================
+# REQUEST TIMING & PROFILING
+# ============================================================================
+
+# Profile 1 in N API requests with the sampling profiler (0 = off)
+PROFILE_SAMPLE_RATE = int(os.getenv('PROFILE_SAMPLE_RATE', 0))
+
+# Sampled requests slower than this (ms) get their stacks written to PROFILE_FOLDER
+PROFILE_SLOW_MS = float(os.getenv('PROFILE_SLOW_MS', 2000))
+
+# Seconds between stack samples
+PROFILE_INTERVAL = 0.005
+
+PROFILE_FOLDER = 'profiles'
+
+# Per-phase spans in the public Server-Timing header reveal which code paths ran
+# (e.g. a password check only for existing accounts), so by default clients only
+# see the total; set SERVER_TIMING_DETAIL=1 to expose every span while debugging.
+# The JSON request log always has the full breakdown.
+SERVER_TIMING_DETAIL = os.getenv('SERVER_TIMING_DETAIL', '0') == '1'
+
+def record_span(name, seconds):
+    """Add time to a named span of the current request (no-op outside requests)."""
+    if has_request_context() and 'spans' in g:
+        g.spans[name] = g.spans.get(name, 0.0) + seconds
+
+@contextmanager
+def span(name):
+    """Time a block of work and report it in the request's Server-Timing header."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+# The start time lives on the per-statement execution context, so a failed
+# statement (no after_cursor_execute) leaves nothing behind on the connection
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_start = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    query_start = getattr(context, 'query_start', None)
+    if query_start is not None:
+        record_span('db', time.perf_counter() - query_start)
+
+class StackSampler:
+    """Samples one thread's call stack in the background, in flamegraph folded format."""
+    
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+    
+    def start(self):
+        self._thread.start()
+    
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+    
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+    
+    def folded(self):
+        """Collapsed stacks, one "frame;frame;frame count" line each."""
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+@app.before_request
+def start_request_timer():
+    """Start timing the request and, for 1 in PROFILE_SAMPLE_RATE API calls, sampling it."""
+    g.request_start = time.perf_counter()
+    g.spans = {}
+    g.profiler = None
+    if PROFILE_SAMPLE_RATE and request.path.startswith('/api/') and random.randrange(PROFILE_SAMPLE_RATE) == 0:
+        g.profiler = StackSampler(threading.get_ident())
+        g.profiler.start()
+
+@app.after_request
+def add_server_timing(response):
+    """Emit Server-Timing and a JSON log line for API requests, and dump slow profiles."""
+    if 'request_start' not in g or not request.path.startswith('/api/'):
+        return response
+    
+    total_ms = (time.perf_counter() - g.request_start) * 1000
+    spans = {name: round(seconds * 1000, 1) for name, seconds in g.spans.items()}
+    metrics = [f"{name};dur={ms}" for name, ms in spans.items()] if SERVER_TIMING_DETAIL else []
+    metrics.append(f"total;dur={total_ms:.1f}")
+    response.headers['Server-Timing'] = ', '.join(metrics)
+    
+    profile_path = None
+    if g.profiler:
+        g.profiler.stop()
+        if total_ms >= PROFILE_SLOW_MS and g.profiler.stacks:
+            os.makedirs(PROFILE_FOLDER, exist_ok=True)
+            profile_path = os.path.join(
+                PROFILE_FOLDER,
+                f"{time.strftime('%Y%m%d-%H%M%S')}_{request.endpoint}_{uuid.uuid4().hex[:8]}.folded"
+            )
+            with open(profile_path, 'w') as f:
+                f.write(g.profiler.folded())
+    
+    print(json.dumps({
+        "event": "request",
+        "method": request.method,
+        "path": request.path,
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "duration_ms": round(total_ms, 1),
+        "spans": spans,
+        "profile": profile_path,
+    }), flush=True)
+    return response
+
+@app.teardown_request
+def stop_request_profiler(exc):
+    """Stop the stack sampler even if the request raised before after_request ran."""
+    profiler = g.get('profiler')
+    if profiler:
+        profiler.stop()
+
+# ============================================================================
+# CPU WORKER POOL
+# ============================================================================
+
+# Hashing, image/video decoding and encoding run here instead of on request threads.
+# "thread" suits this work because hashlib, Pillow and OpenCV release the GIL while
+# they crunch; "process" uses forked workers for full parallelism at the cost of
+# pickling arguments. base64 (binascii) holds the GIL, so a thread hop can't move it
+# to another core and pickling multi-MB payloads costs as much as encoding them: it
+# runs inline on the request thread, with only its concurrency bounded by the pool.
+CPU_POOL_KIND = os.getenv('CPU_POOL_KIND', 'thread')
+CPU_POOL_WORKERS = int(os.getenv('CPU_POOL_WORKERS', os.cpu_count() or 2))
+
+# Max tasks running or queued at once; beyond this, new work is rejected with 503
+CPU_POOL_MAX_QUEUE = int(os.getenv('CPU_POOL_MAX_QUEUE', CPU_POOL_WORKERS * 4))
+
+# Password hashing and checking run on a separate small pool, so a burst of media
+# work can't push logins and registrations into 503s
+AUTH_POOL_WORKERS = int(os.getenv('AUTH_POOL_WORKERS', 2))
+AUTH_POOL_MAX_QUEUE = int(os.getenv('AUTH_POOL_MAX_QUEUE', AUTH_POOL_WORKERS * 8))
+
+class CpuPoolBusy(Exception):
+    """Raised when the CPU worker pool queue is full."""
+
+def new_cpu_pool_metrics():
+    return {
+        "submitted": 0,
+        "completed": 0,
+        "failed": 0,
+        "rejected": 0,
+        "in_flight": 0,
+        "max_in_flight": 0,
+        "wait_seconds": 0.0,
+        "run_seconds": 0.0,
+        "tasks": {},
+    }
+
+cpu_pools = {}
+cpu_pool_lock = threading.Lock()
+cpu_pool_slots = {
+    'media': threading.BoundedSemaphore(CPU_POOL_MAX_QUEUE),
+    'auth': threading.BoundedSemaphore(AUTH_POOL_MAX_QUEUE),
+}
+cpu_pool_metrics = {pool: new_cpu_pool_metrics() for pool in cpu_pool_slots}
+
+def get_cpu_pool(pool='media'):
+    """Create a worker pool on first use (after any fork by the app server)."""
+    with cpu_pool_lock:
+        if pool not in cpu_pools:
+            if pool == 'auth':
+                cpu_pools[pool] = ThreadPoolExecutor(AUTH_POOL_WORKERS, thread_name_prefix='auth-worker')
+            elif CPU_POOL_KIND == 'process':
+                cpu_pools[pool] = ProcessPoolExecutor(CPU_POOL_WORKERS, mp_context=multiprocessing.get_context('fork'))
+            else:
+                cpu_pools[pool] = ThreadPoolExecutor(CPU_POOL_WORKERS, thread_name_prefix='cpu-worker')
+        return cpu_pools[pool]
+
+def timed_call(fn, args, kwargs):
+    """Call fn in a pool worker and report how long it ran."""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def submit_cpu_task(pool, fn, args, kwargs):
+    """Run fn on a worker pool, replacing the pool if one of its processes died."""
+    executor = get_cpu_pool(pool)
+    try:
+        return executor.submit(timed_call, fn, args, kwargs).result()
+    except BrokenProcessPool:
+        # A worker was killed (e.g. OOM on a huge upload). The executor stays broken
+        # for good, so drop it and let the next task start a fresh one.
+        with cpu_pool_lock:
+            if cpu_pools.get(pool) is executor:
+                del cpu_pools[pool]
+        executor.shutdown(wait=False)
+        raise
+
+def run_cpu_task(name, fn, *args, block=False, pool='media', inline=False, **kwargs):
+    """Run CPU-heavy work on a worker pool ('media' or 'auth') and wait for its result.
+    
+    Raises CpuPoolBusy when the queue is full, unless block=True (for work that
+    must finish, e.g. after credits were committed), which waits for a slot instead.
+    inline=True runs fn on the calling thread, still holding a pool slot, for work
+    that holds the GIL and gains nothing from a worker.
+    """
+    slots = cpu_pool_slots[pool]
+    metrics = cpu_pool_metrics[pool]
+    if not slots.acquire(blocking=block):
+        with cpu_pool_lock:
+            metrics["rejected"] += 1
+        raise CpuPoolBusy("Server is busy, please retry shortly")
+    
+    with cpu_pool_lock:
+        metrics["submitted"] += 1
+        metrics["in_flight"] += 1
+        metrics["max_in_flight"] = max(metrics["max_in_flight"], metrics["in_flight"])
+    
+    start = time.perf_counter()
+    outcome = "failed"
+    run_seconds = 0.0
+    try:
+        if inline:
+            result, run_seconds = timed_call(fn, args, kwargs)
+        else:
+            result, run_seconds = submit_cpu_task(pool, fn, args, kwargs)
+        outcome = "completed"
+        return result
+    finally:
+        slots.release()
+        wait_seconds = max(0.0, time.perf_counter() - start - run_seconds)
+        record_span(name, run_seconds)
+        record_span('cpu_queue', wait_seconds)
+        with cpu_pool_lock:
+            metrics["in_flight"] -= 1
+            metrics[outcome] += 1
+            metrics["wait_seconds"] += wait_seconds
+            metrics["run_seconds"] += run_seconds
+            metrics["tasks"][name] = metrics["tasks"].get(name, 0) + 1
+
+@app.errorhandler(CpuPoolBusy)
+def handle_cpu_pool_busy(e):
+    """Tell clients to back off when the CPU pool is saturated."""
+    return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
+
+def decode_image(image_data):
+    """Fully decode image bytes into a PIL image."""
+    image = Image.open(io.BytesIO(image_data))
+    image.load()
+    return image
+
+def encode_base64(data):
+    """Base64-encode bytes into a str for JSON responses."""
+    return base64.b64encode(data).decode()
+
+# ============================================================================
+# IDEMPOTENCY KEYS
+# ============================================================================
+
+# Large response fields that are already saved under outputs/<filename>; they are
+# dropped from stored responses and re-read from the file on replay
+INLINE_OUTPUT_FIELDS = ('image', 'video', 'html')
+
+def request_fingerprint():
+    """Hash what defines a request, so a key reused for a different request is caught."""
+    digest = hashlib.sha256(f"{request.method} {request.path}?".encode())
+    digest.update(request.query_string)
+    
+    body = request.get_json(silent=True)
+    if body is not None:
+        digest.update(json.dumps(body, sort_keys=True).encode())
+    for name, value in sorted(request.form.items(multi=True)):
+        digest.update(f"{name}={value}".encode())
+    for name, file in sorted(request.files.items(multi=True), key=lambda item: item[0]):
+        digest.update(name.encode())
+        # Uploads can be up to MAX_CONTENT_LENGTH; hash them without loading them whole
+        for chunk in iter(lambda: file.read(64 * 1024), b''):
+            digest.update(chunk)
+        file.seek(0)
+    
+    return digest.hexdigest()
+
+def get_idempotency_record(user_id, key):
+    """Fetch the stored record for a key, or None."""
+    with get_db() as conn:
+        record = conn.execute(
+            text("SELECT * FROM idempotency_keys WHERE user_id = :user_id AND idempotency_key = :key"),
+            {"user_id": user_id, "key": key}
+        ).mappings().first()
+    return dict(record) if record else None
+
+def is_abandoned_idempotency_record(record, now):
+    """True for records the purge hasn't removed yet: expired, or in progress past the lock timeout."""
+    return record['expires_at'] < now or (
+        record['status'] == 'in_progress' and record['started_at'] < now - IDEMPOTENCY_LOCK_TIMEOUT
+    )
+
+def claim_idempotency_key(user_id, key, fingerprint):
+    """Claim a key for this request. Returns None if claimed, else the existing record."""
+    while True:
+        now = time.time()
+        try:
+            with get_db() as conn:
+                conn.execute(
+                    text('''
+                        INSERT INTO idempotency_keys (user_id, idempotency_key, fingerprint, status, started_at, expires_at)
+                        VALUES (:user_id, :key, :fingerprint, 'in_progress', :now, :expires_at)
+                    '''),
+                    {"user_id": user_id, "key": key, "fingerprint": fingerprint, "now": now, "expires_at": now + IDEMPOTENCY_TTL}
+                )
+            return None
+        except IntegrityError:
+            record = get_idempotency_record(user_id, key)
+        
+        if record is None:
+            # The original request failed and released the key in between; claim again
+            continue
+        if not is_abandoned_idempotency_record(record, now):
+            return record
+        
+        # Take over an abandoned record; the started_at check makes sure only one
+        # waiting request wins if several notice it at once
+        with get_db() as conn:
+            result = conn.execute(
+                text('''
+                    UPDATE idempotency_keys
+                    SET fingerprint = :fingerprint, status = 'in_progress', response_status = NULL,
+                        response_body = NULL, inline_field = NULL, started_at = :now, expires_at = :expires_at
+                    WHERE user_id = :user_id AND idempotency_key = :key AND started_at = :started_at
+                '''),
+                {"fingerprint": fingerprint, "now": now, "expires_at": now + IDEMPOTENCY_TTL,
+                 "user_id": user_id, "key": key, "started_at": record['started_at']}
+            )
+        if result.rowcount == 1:
+            return None
+
+def poll_idempotency_key(user_id, key, fingerprint):
+    """Re-check a key held by another request with a plain read.
+    
+    Only tries to claim it again once the row is gone or abandoned.
+    """
+    record = get_idempotency_record(user_id, key)
+    if record is not None and not is_abandoned_idempotency_record(record, time.time()):
+        return record
+    return claim_idempotency_key(user_id, key, fingerprint)
+
+def purge_idempotency_keys():
+    """Delete expired keys. Runs on the background reconciler thread."""
+    with get_db() as conn:
+        result = conn.execute(text("DELETE FROM idempotency_keys WHERE expires_at < :now"), {"now": time.time()})
+    return result.rowcount
+
+def complete_idempotency_key(user_id, key, response):
+    """Store the response for replays, or release the key if it cannot be replayed."""
+    body = response.get_json(silent=True)
+    if response.status_code >= 500 or body is None:
+        release_idempotency_key(user_id, key)
+        return
+    
+    inline_field = None
+    if isinstance(body, dict) and body.get('filename'):
+        for field in INLINE_OUTPUT_FIELDS:
+            if field in body:
+                body = {k: v for k, v in body.items() if k != field}
+                inline_field = field
+                break
+    
+    with get_db() as conn:
+        store_idempotent_response(conn, user_id, key, response.status_code, body, inline_field)
+
+def store_idempotent_response(conn, user_id, key, status, body, inline_field=None):
+    """Mark a key completed with the response to replay, inside the caller's transaction."""
+    conn.execute(
+        text('''
+            UPDATE idempotency_keys
+            SET status = 'completed', response_status = :status, response_body = :body, inline_field = :inline_field
+            WHERE user_id = :user_id AND idempotency_key = :key
+        '''),
+        {"status": status, "body": json.dumps(body), "inline_field": inline_field, "user_id": user_id, "key": key}
+    )
+
+def complete_idempotent_request(conn, status, body):
+    """Complete the current request's Idempotency-Key in the same transaction as its side effects.
+    
+    For handlers whose writes must never run twice (e.g. granting credits): if the
+    worker dies right after committing, the key is already completed and a retry
+    replays the response instead of repeating the writes. No-op without a key.
+    """
+    key = g.get('idempotency_key')
+    if key:
+        store_idempotent_response(conn, get_jwt_identity(), key, status, body)
+        g.idempotency_completed = True
+
+def release_idempotency_key(user_id, key):
+    """Forget a key whose request failed, so a retry runs it again."""
+    with get_db() as conn:
+        conn.execute(
+            text("DELETE FROM idempotency_keys WHERE user_id = :user_id AND idempotency_key = :key"),
+            {"user_id": user_id, "key": key}
+        )
+
+def replay_idempotent_response(record):
+    """Rebuild a stored response, re-reading large outputs from the outputs folder.
+    
+    If the output file has been deleted since, the response is replayed without
+    the inline field; clients can still see the filename and variant URLs.
+    """
+    body = json.loads(record['response_body'])
+    field = record['inline_field']
+    if field:
+        path = os.path.join('outputs', body['filename'])
+        try:
+            if field == 'html':
+                with open(path, 'r', encoding='utf-8') as f:
+                    body[field] = f.read()
+            else:
+                with open(path, 'rb') as f:
+                    body[field] = run_cpu_task('base64', encode_base64, f.read(), block=True, inline=True)
+        except FileNotFoundError:
+            print(f"Idempotent replay: {path} is gone, replaying without '{field}'")
+    
+    response = make_response(jsonify(body), record['response_status'])
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def idempotent(fn):
+    """Honor the Idempotency-Key header: run fn once per key and replay its response.
+    
+    A retry that arrives while the original is still running waits for it. Must be
+    applied below @jwt_required(), since keys are scoped per user.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return fn(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({"error": "Idempotency-Key must be at most 255 characters"}), 400
+        
+        user_id = get_jwt_identity()
+        fingerprint = request_fingerprint()
+        deadline = time.time() + IDEMPOTENCY_WAIT_TIMEOUT
+        
+        record = claim_idempotency_key(user_id, key, fingerprint)
+        while record is not None:
+            if record['fingerprint'] != fingerprint:
+                return jsonify({"error": "Idempotency-Key was already used for a different request"}), 422
+            if record['status'] == 'completed':
+                return replay_idempotent_response(record)
+            if time.time() >= deadline:
+                return jsonify({"error": "A request with this Idempotency-Key is still in progress"}), 409
+            time.sleep(0.5)
+            record = poll_idempotency_key(user_id, key, fingerprint)
+        
+        g.idempotency_key = key
+        try:
+            response = make_response(fn(*args, **kwargs))
+        except Exception:
+            release_idempotency_key(user_id, key)
+            raise
+        if not g.get('idempotency_completed'):
+            complete_idempotency_key(user_id, key, response)
+        return response
+    
+    return wrapper
 
 # ============================================================================
 # AI FUNCTIONS
@@ -247,12 +1290,13 @@ def generate_image_gemini(prompt, api_key=None):
         
         model = genai.GenerativeModel('gemini-2.0-flash-exp')
         
-        response = model.generate_content(
-            f"Generate an image: {prompt}",
-            generation_config=genai.GenerationConfig(
-                response_mime_type="image/png"
+        with span('upstream'):
+            response = model.generate_content(
+                f"Generate an image: {prompt}",
+                generation_config=genai.GenerationConfig(
+                    response_mime_type="image/png"
+                )
             )
-        )
         
         if response.candidates and response.candidates[0].content.parts:
             for part in response.candidates[0].content.parts:
@@ -271,7 +1315,7 @@ def describe_image_gemini(image_data, api_key=None):
             return None, "Please configure Google API key"
         
         model = genai.GenerativeModel('gemini-2.0-flash')
-        image = Image.open(io.BytesIO(image_data))
+        image = run_cpu_task('image_decode', decode_image, image_data)
         
         prompt = """Analyze this image in detail and create an enhanced prompt for AI image generation. Include:
         1. Main subject and composition
@@ -282,9 +1326,13 @@ def describe_image_gemini(image_data, api_key=None):
         
         Format as a single, detailed image generation prompt."""
         
-        response = model.generate_content([prompt, image])
+        with span('upstream'):
+            response = model.generate_content([prompt, image])
         return response.text, None
         
+    except CpuPoolBusy:
+        # Let the 503 + Retry-After handler answer instead of reporting a failure
+        raise
     except Exception as e:
         return None, str(e)
 
@@ -337,7 +1385,8 @@ def describe_video_frames(frames, api_key=None):
         Format as a single video generation prompt."""
         
         content = [prompt] + frames
-        response = model.generate_content(content)
+        with span('upstream'):
+            response = model.generate_content(content)
         return response.text, None
         
     except Exception as e:
@@ -364,7 +1413,8 @@ def generate_landing_page(idea, api_key=None):
         
         Return ONLY the complete HTML code, no explanations."""
         
-        response = model.generate_content(prompt)
+        with span('upstream'):
+            response = model.generate_content(prompt)
         
         text = response.text
         if "```html" in text:
@@ -380,27 +1430,30 @@ def generate_landing_page(idea, api_key=None):
 def virtual_tryon(person_path, clothes_path, garment_desc="", api_key=None):
     """Virtual try-on using IDM-VTON."""
     try:
-        if api_key:
-            client = Client("yisol/IDM-VTON", hf_token=api_key)
-        else:
-            client = Client("yisol/IDM-VTON")
-        
-        result = client.predict(
-            dict={"background": handle_file(person_path), "layers": [], "composite": None},
-            garm_img=handle_file(clothes_path),
-            garment_des=garment_desc or "A piece of clothing",
-            is_checked=True,
-            is_checked_crop=False,
-            denoise_steps=30,
-            seed=42,
-            api_name="/tryon"
-        )
+        with span('client_init'):
+            if api_key:
+                client = Client("yisol/IDM-VTON", hf_token=api_key)
+            else:
+                client = Client("yisol/IDM-VTON")
+        
+        with span('upstream'):
+            result = client.predict(
+                dict={"background": handle_file(person_path), "layers": [], "composite": None},
+                garm_img=handle_file(clothes_path),
+                garment_des=garment_desc or "A piece of clothing",
+                is_checked=True,
+                is_checked_crop=False,
+                denoise_steps=30,
+                seed=42,
+                api_name="/tryon"
+            )
         
         if result and isinstance(result, (list, tuple)):
             result_path = result[0] if isinstance(result[0], str) else result[0]
             if os.path.exists(str(result_path)):
-                with open(result_path, 'rb') as f:
-                    return f.read(), None
+                with span('result_read'):
+                    with open(result_path, 'rb') as f:
+                        return f.read(), None
         
         return None, "Virtual try-on failed"
         
@@ -411,7 +1464,8 @@ def generate_video_hf(prompt, api_key=None):
     """Generate video using HuggingFace."""
     try:
         client = get_hf_client(api_key)
-        result = client.text_to_video(prompt, model="ali-vilab/text-to-video-ms-1.7b")
+        with span('upstream'):
+            result = client.text_to_video(prompt, model="ali-vilab/text-to-video-ms-1.7b")
         
         if result:
             return result, None
@@ -426,8 +1480,35 @@ def generate_video_hf(prompt, api_key=None):
 
 @app.route('/')
 def index():
-    """Serve main page."""
-    return send_from_directory('static', 'index.html')
+    """Serve main page with fingerprinted asset references."""
+    encoding = choose_content_encoding(available_encodings())
+    response = app.response_class(INDEX_PAGE[encoding or "identity"], mimetype='text/html')
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    response.set_etag(f"{INDEX_PAGE['etag']}-{encoding or 'identity'}")
+    return response.make_conditional(request)
+
+@app.route('/assets/<filename>')
+def static_asset(filename):
+    """Serve a fingerprinted static asset, precompressed when the client allows."""
+    path = safe_join(ASSET_BUILD_FOLDER, filename)
+    if not path or not os.path.isfile(path):
+        return jsonify({"error": "Asset not found"}), 404
+    
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = choose_content_encoding(
+        [e for e, suffix in PRECOMPRESSED_SUFFIXES.items() if os.path.isfile(path + suffix)]
+    )
+    if encoding:
+        response = send_file(path + PRECOMPRESSED_SUFFIXES[encoding], mimetype=mimetype, max_age=ASSET_MAX_AGE)
+        response.content_encoding = encoding
+    else:
+        response = send_file(path, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 @app.route('/api/recaptcha-key', methods=['GET'])
@@ -483,19 +1564,21 @@ def register():
     if len(password) < 6:
         return jsonify({"error": "Password must be at least 6 characters"}), 400
     
-    conn = get_db()
+    password_hash = run_cpu_task('password_hash', generate_password_hash, password, pool='auth')
+    
     try:
-        conn.execute(
-            "INSERT INTO users (email, password_hash) VALUES (?, ?)",
-            (email, generate_password_hash(password))
-        )
-        conn.commit()
-        conn.close()
+        with get_db() as conn:
+            conn.execute(
+                text("INSERT INTO users (email, password_hash) VALUES (:email, :password_hash)"),
+                {"email": email, "password_hash": password_hash}
+            )
         return jsonify({"message": "Registration successful"}), 201
-    except sqlite3.IntegrityError:
-        conn.close()
+    except IntegrityError:
         return jsonify({"error": "Email already exists"}), 400
 
+# Compared against when the email is unknown, so login timing doesn't reveal which accounts exist
+DUMMY_PASSWORD_HASH = generate_password_hash(uuid.uuid4().hex)
+
 @app.route('/api/auth/login', methods=['POST'])
 def login():
     """Login user."""
@@ -508,11 +1591,16 @@ def login():
     if not verify_recaptcha(captcha_token):
         return jsonify({"error": "Please complete the CAPTCHA verification"}), 400
     
-    conn = get_db()
-    user = conn.execute("SELECT * FROM users WHERE email = ?", (email,)).fetchone()
-    conn.close()
+    with get_db() as conn:
+        user = conn.execute(
+            text("SELECT * FROM users WHERE email = :email"),
+            {"email": email}
+        ).mappings().first()
     
-    if not user or not check_password_hash(user['password_hash'], password):
+    # Check against a dummy hash for unknown emails so both cases take as long
+    password_hash = user['password_hash'] if user else DUMMY_PASSWORD_HASH
+    password_ok = run_cpu_task('password_check', check_password_hash, password_hash, password, pool='auth')
+    if not user or not password_ok:
         return jsonify({"error": "Invalid email or password"}), 401
     
     access_token = create_access_token(identity=str(user['id']))
@@ -539,21 +1627,23 @@ def get_current_user():
         if not user:
             print(f"DEBUG: User {user_id} not found in DB")
             return jsonify({"error": "User not found"}), 404
-    
-    # Get usage stats
-    img_usage = get_user_usage(user_id, "image")
-    vid_usage = get_user_usage(user_id, "video")
-    
-    return jsonify({
-        "id": user['id'],
-        "email": user['email'],
-        "is_premium": bool(user['is_premium']),
-        "credits": user['credits'],
-        "usage": {
-            "image": {"used": img_usage, "limit": FREE_IMAGE_LIMIT},
-            "video": {"used": vid_usage, "limit": FREE_VIDEO_LIMIT}
-        }
-    })
+        
+        # Get usage stats
+        img_usage = get_user_usage(user_id, "image")
+        vid_usage = get_user_usage(user_id, "video")
+        
+        return jsonify({
+            "id": user['id'],
+            "email": user['email'],
+            "is_premium": bool(user['is_premium']),
+            "credits": user['credits'],
+            "usage": {
+                "image": {"used": img_usage, "limit": FREE_IMAGE_LIMIT},
+                "video": {"used": vid_usage, "limit": FREE_VIDEO_LIMIT}
+            }
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
 # ============================================================================
 # API ROUTES - CREDITS
@@ -566,6 +1656,7 @@ def get_packages():
 
 @app.route('/api/credits/purchase', methods=['POST'])
 @jwt_required()
+@idempotent
 def purchase_credits():
     """Simulate credit purchase."""
     user_id = get_jwt_identity()
@@ -577,23 +1668,25 @@ def purchase_credits():
     
     package = CREDIT_PACKAGES[package_id]
     
-    conn = get_db()
-    conn.execute(
-        "UPDATE users SET credits = credits + ?, is_premium = 1 WHERE id = ?",
-        (package['credits'], user_id)
-    )
-    conn.execute(
-        "INSERT INTO transactions (user_id, package, amount, credits) VALUES (?, ?, ?, ?)",
-        (user_id, package_id, package['price'], package['credits'])
-    )
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute(
+            text("UPDATE users SET credits = credits + :credits, is_premium = 1 WHERE id = :user_id"),
+            {"credits": package['credits'], "user_id": user_id}
+        )
+        add_ledger_entry(conn, user_id, 'purchase', package['credits'])
+        conn.execute(
+            text("INSERT INTO transactions (user_id, package, amount, credits) VALUES (:user_id, :package, :amount, :credits)"),
+            {"user_id": user_id, "package": package_id, "amount": package['price'], "credits": package['credits']}
+        )
+        credits = conn.execute(text("SELECT credits FROM users WHERE id = :user_id"), {"user_id": user_id}).scalar()
+        result = {
+            "message": f"Added {package['credits']} credits!",
+            "credits": credits
+        }
+        # Commit the replayable response with the grant, so a crash can't lead to a second grant
+        complete_idempotent_request(conn, 200, result)
     
-    user = get_user_by_id(user_id)
-    return jsonify({
-        "message": f"Added {package['credits']} credits!",
-        "credits": user['credits']
-    })
+    return jsonify(result)
 
 # ============================================================================
 # API ROUTES - AI FEATURES
@@ -601,14 +1694,11 @@ def purchase_credits():
 
 @app.route('/api/generate/image', methods=['POST'])
 @jwt_required()
+@idempotent
 def api_generate_image():
     """Generate image from prompt."""
     user_id = get_jwt_identity()
     
-    can_use, error = check_usage_limit(user_id, "image", FREE_IMAGE_LIMIT)
-    if not can_use:
-        return jsonify({"error": error}), 403
-    
     data = request.json
     prompt = data.get('prompt', '')
     api_key = data.get('api_key')
@@ -616,23 +1706,36 @@ def api_generate_image():
     if not prompt:
         return jsonify({"error": "Prompt required"}), 400
     
-    image_data, error = generate_image_gemini(prompt, api_key)
-    
+    hold, error = reserve_usage(user_id, "image", FREE_IMAGE_LIMIT)
     if error:
-        return jsonify({"error": error}), 500
+        return jsonify({"error": error}), 403
     
-    consume_usage(user_id, "image")
+    try:
+        image_data, error = generate_image_gemini(prompt, api_key)
+        
+        if error:
+            release_usage(hold)
+            return jsonify({"error": error}), 500
+    except Exception:
+        release_usage(hold)
+        raise
+    
+    commit_usage(hold)
     
     # Save and return
     filename = f"generated_{uuid.uuid4().hex[:8]}.png"
     filepath = os.path.join('outputs', filename)
-    with open(filepath, 'wb') as f:
-        f.write(image_data)
-    
-    return jsonify({
-        "image": base64.b64encode(image_data).decode(),
-        "filename": filename
-    })
+    with span('output_save'):
+        with open(filepath, 'wb') as f:
+            f.write(image_data)
+    
+    result = {
+        "filename": filename,
+        "variants": variant_urls(filename)
+    }
+    if wants_inline_output():
+        result["image"] = run_cpu_task('base64', encode_base64, image_data, block=True, inline=True)
+    return jsonify(result)
 
 @app.route('/api/prompt/image', methods=['POST'])
 @jwt_required()
@@ -640,23 +1743,29 @@ def api_prompt_from_image():
     """Generate prompt from uploaded image."""
     user_id = get_jwt_identity()
     
-    can_use, error = check_usage_limit(user_id, "image", FREE_IMAGE_LIMIT)
-    if not can_use:
-        return jsonify({"error": error}), 403
-    
     if 'image' not in request.files:
         return jsonify({"error": "No image uploaded"}), 400
     
     file = request.files['image']
-    image_data = file.read()
+    with span('upload_read'):
+        image_data = file.read()
     api_key = request.form.get('api_key')
     
-    prompt, error = describe_image_gemini(image_data, api_key)
-    
+    hold, error = reserve_usage(user_id, "image", FREE_IMAGE_LIMIT)
     if error:
-        return jsonify({"error": error}), 500
+        return jsonify({"error": error}), 403
     
-    consume_usage(user_id, "image")
+    try:
+        prompt, error = describe_image_gemini(image_data, api_key)
+        
+        if error:
+            release_usage(hold)
+            return jsonify({"error": error}), 500
+    except Exception:
+        release_usage(hold)
+        raise
+    
+    commit_usage(hold)
     return jsonify({"prompt": prompt})
 
 @app.route('/api/prompt/video', methods=['POST'])
@@ -665,10 +1774,6 @@ def api_prompt_from_video():
     """Generate prompt from uploaded video."""
     user_id = get_jwt_identity()
     
-    can_use, error = check_usage_limit(user_id, "video", FREE_VIDEO_LIMIT)
-    if not can_use:
-        return jsonify({"error": error}), 403
-    
     if 'video' not in request.files:
         return jsonify({"error": "No video uploaded"}), 400
     
@@ -677,20 +1782,32 @@ def api_prompt_from_video():
     
     # Save temporarily
     temp_path = os.path.join('uploads', f"temp_{uuid.uuid4().hex[:8]}.mp4")
-    file.save(temp_path)
+    with span('upload_save'):
+        file.save(temp_path)
     
-    frames, error = extract_video_frames(temp_path)
-    os.unlink(temp_path)
+    try:
+        frames, error = run_cpu_task('frame_extract', extract_video_frames, temp_path)
+    finally:
+        os.unlink(temp_path)
     
     if error:
         return jsonify({"error": error}), 400
     
-    prompt, error = describe_video_frames(frames, api_key)
-    
+    hold, error = reserve_usage(user_id, "video", FREE_VIDEO_LIMIT)
     if error:
-        return jsonify({"error": error}), 500
+        return jsonify({"error": error}), 403
     
-    consume_usage(user_id, "video")
+    try:
+        prompt, error = describe_video_frames(frames, api_key)
+        
+        if error:
+            release_usage(hold)
+            return jsonify({"error": error}), 500
+    except Exception:
+        release_usage(hold)
+        raise
+    
+    commit_usage(hold)
     return jsonify({"prompt": prompt})
 
 @app.route('/api/generate/landing', methods=['POST'])
@@ -699,10 +1816,6 @@ def api_generate_landing():
     """Generate landing page."""
     user_id = get_jwt_identity()
     
-    can_use, error = check_usage_limit(user_id, "image", FREE_IMAGE_LIMIT)
-    if not can_use:
-        return jsonify({"error": error}), 403
-    
     data = request.json
     idea = data.get('idea', '')
     api_key = data.get('api_key')
@@ -710,18 +1823,28 @@ def api_generate_landing():
     if not idea:
         return jsonify({"error": "Idea required"}), 400
     
-    html_code, error = generate_landing_page(idea, api_key)
-    
+    hold, error = reserve_usage(user_id, "image", FREE_IMAGE_LIMIT)
     if error:
-        return jsonify({"error": error}), 500
+        return jsonify({"error": error}), 403
+    
+    try:
+        html_code, error = generate_landing_page(idea, api_key)
+        
+        if error:
+            release_usage(hold)
+            return jsonify({"error": error}), 500
+    except Exception:
+        release_usage(hold)
+        raise
     
-    consume_usage(user_id, "image")
+    commit_usage(hold)
     
     # Save file
     filename = f"landing_{uuid.uuid4().hex[:8]}.html"
     filepath = os.path.join('outputs', filename)
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.write(html_code)
+    with span('output_save'):
+        with open(filepath, 'w', encoding='utf-8') as f:
+            f.write(html_code)
     
     return jsonify({
         "html": html_code,
@@ -730,14 +1853,11 @@ def api_generate_landing():
 
 @app.route('/api/tryon', methods=['POST'])
 @jwt_required()
+@idempotent
 def api_virtual_tryon():
     """Virtual try-on clothes swap."""
     user_id = get_jwt_identity()
     
-    can_use, error = check_usage_limit(user_id, "image", FREE_IMAGE_LIMIT)
-    if not can_use:
-        return jsonify({"error": error}), 403
-    
     if 'person' not in request.files or 'clothes' not in request.files:
         return jsonify({"error": "Both person and clothes images required"}), 400
     
@@ -746,45 +1866,57 @@ def api_virtual_tryon():
     garment_desc = request.form.get('description', '')
     api_key = request.form.get('hf_token')
     
+    hold, error = reserve_usage(user_id, "image", FREE_IMAGE_LIMIT)
+    if error:
+        return jsonify({"error": error}), 403
+    
     # Save temporarily
     person_path = os.path.join('uploads', f"person_{uuid.uuid4().hex[:8]}.png")
     clothes_path = os.path.join('uploads', f"clothes_{uuid.uuid4().hex[:8]}.png")
     
-    person_file.save(person_path)
-    clothes_file.save(clothes_path)
-    
-    result_data, error = virtual_tryon(person_path, clothes_path, garment_desc, api_key)
-    
-    # Cleanup
-    os.unlink(person_path)
-    os.unlink(clothes_path)
-    
-    if error:
-        return jsonify({"error": error}), 500
-    
-    consume_usage(user_id, "image")
+    try:
+        with span('upload_save'):
+            person_file.save(person_path)
+            clothes_file.save(clothes_path)
+        
+        result_data, error = virtual_tryon(person_path, clothes_path, garment_desc, api_key)
+        
+        if error:
+            release_usage(hold)
+            return jsonify({"error": error}), 500
+    except Exception:
+        release_usage(hold)
+        raise
+    finally:
+        # Cleanup
+        for path in (person_path, clothes_path):
+            if os.path.exists(path):
+                os.unlink(path)
+    
+    commit_usage(hold)
     
     # Save result
     filename = f"tryon_{uuid.uuid4().hex[:8]}.png"
     filepath = os.path.join('outputs', filename)
-    with open(filepath, 'wb') as f:
-        f.write(result_data)
-    
-    return jsonify({
-        "image": base64.b64encode(result_data).decode(),
-        "filename": filename
-    })
+    with span('output_save'):
+        with open(filepath, 'wb') as f:
+            f.write(result_data)
+    
+    result = {
+        "filename": filename,
+        "variants": variant_urls(filename)
+    }
+    if wants_inline_output():
+        result["image"] = run_cpu_task('base64', encode_base64, result_data, block=True, inline=True)
+    return jsonify(result)
 
 @app.route('/api/generate/video', methods=['POST'])
 @jwt_required()
+@idempotent
 def api_generate_video():
     """Generate video from prompt."""
     user_id = get_jwt_identity()
     
-    can_use, error = check_usage_limit(user_id, "video", FREE_VIDEO_LIMIT)
-    if not can_use:
-        return jsonify({"error": error}), 403
-    
     data = request.json
     prompt = data.get('prompt', '')
     api_key = data.get('hf_token')
@@ -792,32 +1924,106 @@ def api_generate_video():
     if not prompt:
         return jsonify({"error": "Prompt required"}), 400
     
-    video_data, error = generate_video_hf(prompt, api_key)
-    
+    hold, error = reserve_usage(user_id, "video", FREE_VIDEO_LIMIT)
     if error:
-        return jsonify({"error": error}), 500
+        return jsonify({"error": error}), 403
     
-    consume_usage(user_id, "video")
+    try:
+        video_data, error = generate_video_hf(prompt, api_key)
+        
+        if error:
+            release_usage(hold)
+            return jsonify({"error": error}), 500
+    except Exception:
+        release_usage(hold)
+        raise
+    
+    commit_usage(hold)
     
     # Save video
     filename = f"video_{uuid.uuid4().hex[:8]}.mp4"
     filepath = os.path.join('outputs', filename)
-    with open(filepath, 'wb') as f:
-        f.write(video_data)
+    with span('output_save'):
+        with open(filepath, 'wb') as f:
+            f.write(video_data)
+    
+    video_b64 = run_cpu_task('base64', encode_base64, video_data, block=True, inline=True)
     
     return jsonify({
-        "video": base64.b64encode(video_data).decode(),
+        "video": video_b64,
         "filename": filename
     })
 
 @app.route('/api/download/<filename>')
 def download_file(filename):
-    """Download generated file."""
-    return send_from_directory('outputs', filename, as_attachment=True)
+    """Download generated file, optionally as a resized variant (?variant=preview)."""
+    variant = request.args.get('variant')
+    if not variant:
+        return send_from_directory('outputs', filename, as_attachment=True)
+    
+    if variant not in IMAGE_VARIANTS or not is_image_output(filename):
+        return jsonify({"error": "Variant not found"}), 404
+    
+    source_path = safe_join('outputs', filename)
+    if not source_path or not os.path.isfile(source_path):
+        return jsonify({"error": "File not found"}), 404
+    
+    encoding = negotiate_image_encoding(request.accept_mimetypes)
+    variant_path = run_cpu_task('image_encode', get_image_variant, filename, variant, encoding)
+    response = send_file(
+        variant_path,
+        mimetype=encoding[0],
+        as_attachment=True,
+        download_name=f"{os.path.splitext(filename)[0]}_{variant}.{encoding[2]}"
+    )
+    response.vary.add('Accept')
+    return response
+
+@app.route('/api/image/<filename>/<variant>')
+def image_variant(filename, variant):
+    """Serve a resized, content-negotiated variant of a generated image."""
+    if variant not in IMAGE_VARIANTS or not is_image_output(filename):
+        return jsonify({"error": "Variant not found"}), 404
+    
+    source_path = safe_join('outputs', filename)
+    if not source_path or not os.path.isfile(source_path):
+        return jsonify({"error": "File not found"}), 404
+    
+    encoding = negotiate_image_encoding(request.accept_mimetypes)
+    variant_path = run_cpu_task('image_encode', get_image_variant, filename, variant, encoding)
+    response = send_file(variant_path, mimetype=encoding[0], max_age=IMAGE_VARIANT_MAX_AGE)
+    response.vary.add('Accept')
+    return response
+
+# ============================================================================
+# API ROUTES - METRICS
+# ============================================================================
+
+@app.route('/api/metrics/cpu-pool', methods=['GET'])
+def get_cpu_pool_metrics():
+    """Report CPU worker pool sizes, queue depth and timings (media pool at the top level)."""
+    with cpu_pool_lock:
+        metrics = dict(cpu_pool_metrics['media'], tasks=dict(cpu_pool_metrics['media']["tasks"]))
+        auth_metrics = dict(cpu_pool_metrics['auth'], tasks=dict(cpu_pool_metrics['auth']["tasks"]))
+    auth_metrics.update({
+        "kind": "thread",
+        "workers": AUTH_POOL_WORKERS,
+        "max_queue": AUTH_POOL_MAX_QUEUE,
+    })
+    metrics.update({
+        "kind": CPU_POOL_KIND,
+        "workers": CPU_POOL_WORKERS,
+        "max_queue": CPU_POOL_MAX_QUEUE,
+        "auth": auth_metrics,
+    })
+    return jsonify(metrics)
 
 # ============================================================================
 # MAIN
 # ============================================================================
 
 if __name__ == '__main__':
+    # The debug reloader runs this file in a watcher and a serving process; reconcile only in the latter
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_credit_reconciler()
     app.run(debug=True, port=5000)
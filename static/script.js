@@ -319,7 +319,7 @@ async function generateImage() {
     document.getElementById('imageResult').classList.add('hidden');
 
     try {
-        const data = await apiCall('/generate/image', {
+        const data = await apiCall('/generate/image?inline=0', {
             method: 'POST',
             body: JSON.stringify({ prompt, api_key: getCustomApiKey() })
         });
@@ -327,7 +327,7 @@ async function generateImage() {
         completeProgress('imageProgress');
 
         const img = document.getElementById('generatedImage');
-        img.src = `data:image/png;base64,${data.image}`;
+        img.src = data.variants.preview;
         img.dataset.filename = data.filename;
 
         document.getElementById('imageResult').classList.remove('hidden');
@@ -496,7 +496,7 @@ async function virtualTryon() {
         formData.append('description', document.getElementById('garmentDesc').value);
         formData.append('hf_token', getCustomHfToken());
 
-        const data = await apiCall('/tryon', {
+        const data = await apiCall('/tryon?inline=0', {
             method: 'POST',
             body: formData
         });
@@ -504,7 +504,7 @@ async function virtualTryon() {
         completeProgress('tryonProgress');
 
         const img = document.getElementById('tryonImage');
-        img.src = `data:image/png;base64,${data.image}`;
+        img.src = data.variants.preview;
         img.dataset.filename = data.filename;
 
         document.getElementById('tryonResult').classList.remove('hidden');
@@ -618,10 +618,7 @@ function downloadImage(elementId) {
     const img = document.getElementById(elementId);
     if (!img || !img.dataset.filename) return;
 
-    const link = document.createElement('a');
-    link.href = img.src;
-    link.download = img.dataset.filename;
-    link.click();
+    downloadFile(img.dataset.filename);
 }
 
 function downloadFile(filename) {
@@ -0,0 +1,126 @@
+"""
+Shared fixtures: each test imports a fresh copy of app.py inside a temp
+directory, backed by SQLite in file or in-memory mode.
+"""
+
+import importlib
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+from sqlalchemy import MetaData, create_engine
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Optional PostgreSQL run: point this at a scratch database, its tables are dropped per test
+POSTGRES_URL = os.getenv('TEST_POSTGRES_URL')
+
+# The original (pre-migration) schema, as created by the first app.py
+V0_SCHEMA = '''
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        is_premium INTEGER DEFAULT 0,
+        credits REAL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE usage (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        feature TEXT NOT NULL,
+        usage_date DATE NOT NULL,
+        count INTEGER DEFAULT 1,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        UNIQUE(user_id, feature, usage_date)
+    );
+    CREATE TABLE transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        package TEXT NOT NULL,
+        amount REAL NOT NULL,
+        credits INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    );
+'''
+
+
+def file_database_url(tmp_path):
+    return f"sqlite:///{tmp_path / 'database' / 'users.db'}"
+
+
+def reset_database(url):
+    """Drop every table in a server database so each test starts from an empty schema."""
+    engine = create_engine(url)
+    metadata = MetaData()
+    metadata.reflect(engine)
+    metadata.drop_all(engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def load_app(tmp_path, monkeypatch):
+    """Import app.py from scratch with the given DATABASE_URL and env overrides."""
+    loaded = []
+
+    def load(database_url, **env):
+        monkeypatch.syspath_prepend(str(REPO_ROOT))
+        monkeypatch.chdir(tmp_path)
+        if not (tmp_path / 'static').exists():
+            shutil.copytree(REPO_ROOT / 'static', tmp_path / 'static')
+        monkeypatch.setenv('DATABASE_URL', database_url)
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+
+        sys.modules.pop('app', None)
+        module = importlib.import_module('app')
+        # send_file resolves relative paths against root_path; keep it on the temp dir
+        module.app.root_path = str(tmp_path)
+        monkeypatch.setattr(module, 'verify_recaptcha', lambda token: True)
+        loaded.append(module)
+        return module
+
+    yield load
+
+    for module in loaded:
+        with module.app.app_context():
+            module.db.engine.dispose()
+    sys.modules.pop('app', None)
+
+
+@pytest.fixture(params=['file', 'memory', 'postgresql'])
+def app_module(request, tmp_path, load_app):
+    """app.py once per database: SQLite file, SQLite in memory and (optionally) PostgreSQL."""
+    if request.param == 'file':
+        url = file_database_url(tmp_path)
+    elif request.param == 'memory':
+        url = 'sqlite://'
+    else:
+        if not POSTGRES_URL:
+            pytest.skip("set TEST_POSTGRES_URL to run against PostgreSQL")
+        reset_database(POSTGRES_URL)
+        url = POSTGRES_URL
+    return load_app(url)
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def app_context(app_module):
+    with app_module.app.app_context():
+        yield
+
+
+@pytest.fixture
+def auth_headers(client):
+    """Register and log in a user, returning their Authorization header."""
+    credentials = {"email": "user@gmail.com", "password": "secret123"}
+    assert client.post('/api/auth/register', json=credentials).status_code == 201
+    token = client.post('/api/auth/login', json=credentials).get_json()['token']
+    return {"Authorization": f"Bearer {token}"}
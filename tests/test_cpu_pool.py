@@ -0,0 +1,78 @@
+"""CPU worker pools: rejection, the separate auth pool, inline tasks, broken pools and 503s."""
+
+import io
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from conftest import file_database_url
+
+
+@pytest.fixture
+def saturated_media_pool(app_module):
+    """Hold every media pool slot for the duration of a test."""
+    slots = app_module.cpu_pool_slots['media']
+    held = 0
+    while slots.acquire(blocking=False):
+        held += 1
+    yield
+    for _ in range(held):
+        slots.release()
+
+
+def test_full_pool_rejects_without_blocking(app_module, saturated_media_pool):
+    with pytest.raises(app_module.CpuPoolBusy):
+        app_module.run_cpu_task('image_decode', len, b'data')
+    assert app_module.cpu_pool_metrics['media']["rejected"] == 1
+
+
+def test_login_still_works_when_media_pool_is_full(client, app_module, saturated_media_pool):
+    credentials = {"email": "user@gmail.com", "password": "secret123"}
+
+    assert client.post('/api/auth/register', json=credentials).status_code == 201
+    assert client.post('/api/auth/login', json=credentials).status_code == 200
+
+    metrics = client.get('/api/metrics/cpu-pool').get_json()
+    assert metrics["auth"]["tasks"] == {"password_hash": 1, "password_check": 1}
+    assert "password_check" not in metrics["tasks"]
+
+
+def test_busy_pool_during_image_prompt_returns_503_and_releases_usage(
+        client, app_module, auth_headers, monkeypatch, saturated_media_pool):
+    monkeypatch.setattr(app_module, 'configure_gemini', lambda api_key=None: True)
+    monkeypatch.setattr(app_module.genai, 'GenerativeModel', lambda name: object())
+
+    response = client.post(
+        '/api/prompt/image',
+        data={"image": (io.BytesIO(b'not really an image'), 'photo.png')},
+        headers=auth_headers,
+    )
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    with app_module.app.app_context():
+        assert app_module.get_user_usage(1, "image") == 0
+
+
+def test_inline_task_runs_on_calling_thread_and_counts_against_the_pool(app_module):
+    metrics = app_module.cpu_pool_metrics['media']
+
+    def check():
+        assert metrics["in_flight"] == 1
+        return threading.get_ident()
+
+    assert app_module.run_cpu_task('base64', check, inline=True) == threading.get_ident()
+    assert metrics["tasks"] == {"base64": 1}
+    assert metrics["in_flight"] == 0
+
+
+def test_broken_process_pool_is_replaced(tmp_path, load_app):
+    module = load_app(file_database_url(tmp_path), CPU_POOL_KIND='process', CPU_POOL_WORKERS=1)
+
+    with pytest.raises(BrokenProcessPool):
+        module.run_cpu_task('frame_extract', os._exit, 1)
+
+    assert module.run_cpu_task('frame_extract', sum, [1, 2, 3]) == 6
+    module.cpu_pools['media'].shutdown()
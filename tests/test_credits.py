@@ -0,0 +1,156 @@
+"""Credit ledger: holds, commits, releases and reconciliation."""
+
+import io
+import threading
+
+import pytest
+from sqlalchemy import text
+from werkzeug.datastructures import FileStorage
+
+
+def set_balance(module, user_id, credits):
+    """Set a user's balance the way the app does: user row and ledger together."""
+    with module.get_db() as conn:
+        current = conn.execute(text("SELECT credits FROM users WHERE id = :id"), {"id": user_id}).scalar()
+        conn.execute(text("UPDATE users SET credits = :credits WHERE id = :id"), {"credits": credits, "id": user_id})
+        module.add_ledger_entry(conn, user_id, 'adjust', credits - current)
+
+
+def ledger_balance(module, user_id):
+    with module.get_db() as conn:
+        return conn.execute(
+            text("SELECT COALESCE(SUM(amount), 0) FROM credit_ledger WHERE user_id = :id"), {"id": user_id}
+        ).scalar()
+
+
+def usage_count(module, feature="image"):
+    with module.get_db() as conn:
+        return conn.execute(text("SELECT COALESCE(SUM(count), 0) FROM usage WHERE feature = :f"), {"f": feature}).scalar()
+
+
+@pytest.fixture
+def user(app_module, auth_headers, app_context):
+    return 1
+
+
+def test_holds_never_overspend(app_module, user):
+    set_balance(app_module, user, 2)
+    holds = [app_module.hold_credits(user) for _ in range(3)]
+    assert holds[0] and holds[1] and holds[2] is None
+    assert app_module.get_user_by_id(user)['credits'] == 0
+    assert ledger_balance(app_module, user) == 0
+
+
+def test_commit_keeps_and_release_refunds(app_module, user):
+    set_balance(app_module, user, 2)
+    kept, refunded = app_module.hold_credits(user), app_module.hold_credits(user)
+
+    assert app_module.commit_credits(kept)
+    assert app_module.release_credits(refunded)
+    assert not app_module.release_credits(refunded)
+    assert not app_module.release_credits(kept)
+
+    assert app_module.get_user_by_id(user)['credits'] == 1
+    assert ledger_balance(app_module, user) == 1
+
+
+def test_reconcile_releases_expired_holds(app_module, user):
+    set_balance(app_module, user, 1)
+    credit_hold = app_module.hold_credits(user)
+    assert app_module.increment_usage(user, "image", 3, hold_id="usagehold")
+    with app_module.get_db() as conn:
+        conn.execute(text("UPDATE credit_holds SET expires_at = 0 WHERE id = :id"), {"id": credit_hold})
+        conn.execute(text("UPDATE usage_holds SET expires_at = 0"))
+
+    released, corrected = app_module.reconcile_credits()
+
+    assert (released, corrected) == (2, 0)
+    assert app_module.get_user_by_id(user)['credits'] == 1
+    assert usage_count(app_module) == 0
+
+
+def test_reconcile_corrects_drifted_balance(app_module, user):
+    set_balance(app_module, user, 5)
+    with app_module.get_db() as conn:
+        conn.execute(text("UPDATE users SET credits = 50 WHERE id = :id"), {"id": user})
+
+    assert app_module.reconcile_credits() == (0, 1)
+    assert app_module.get_user_by_id(user)['credits'] == 5
+    assert app_module.reconcile_credits() == (0, 0)
+
+
+def test_opening_balance_seeded_from_existing_credits(app_module, user):
+    with app_module.get_db() as conn:
+        conn.execute(text("DELETE FROM credit_ledger"))
+        conn.execute(text("UPDATE users SET credits = 7"))
+        conn.execute(text("DELETE FROM schema_migrations WHERE version >= 2"))
+        conn.execute(text("DROP TABLE credit_holds"))
+    app_module.init_database()
+    assert ledger_balance(app_module, user) == 7
+
+
+def test_failed_generation_releases_credit_hold(app_module, client, auth_headers, monkeypatch):
+    with app_module.app.app_context():
+        set_balance(app_module, 1, 1)
+    monkeypatch.setattr(app_module, 'generate_landing_page', lambda idea, api_key=None: (None, "boom"))
+
+    response = client.post('/api/generate/landing', json={"idea": "shop"}, headers=auth_headers)
+
+    assert response.status_code == 500
+    with app_module.app.app_context():
+        assert app_module.get_user_by_id(1)['credits'] == 1
+
+
+def test_successful_generation_commits_credit_hold(app_module, client, auth_headers, monkeypatch):
+    with app_module.app.app_context():
+        set_balance(app_module, 1, 1)
+    monkeypatch.setattr(app_module, 'generate_landing_page', lambda idea, api_key=None: ("<html></html>", None))
+
+    assert client.post('/api/generate/landing', json={"idea": "shop"}, headers=auth_headers).status_code == 200
+    with app_module.app.app_context():
+        assert app_module.get_user_by_id(1)['credits'] == 0
+        assert ledger_balance(app_module, 1) == 0
+
+
+def test_exception_after_reservation_releases_usage(app_module, client, auth_headers, monkeypatch):
+    def broken_save(self, dst, buffer_size=16384):
+        raise OSError("disk full")
+    monkeypatch.setattr(FileStorage, 'save', broken_save)
+    app_module.app.testing = False
+
+    response = client.post(
+        '/api/tryon',
+        data={"person": (io.BytesIO(b"p"), "p.png"), "clothes": (io.BytesIO(b"c"), "c.png")},
+        headers=auth_headers,
+        content_type='multipart/form-data',
+    )
+
+    assert response.status_code == 500
+    with app_module.app.app_context():
+        assert usage_count(app_module) == 0
+        assert app_module.get_user_usage(1, "image") == 0
+
+
+def test_free_tier_limit_counts_failures_back(app_module, client, auth_headers, monkeypatch):
+    monkeypatch.setattr(app_module, 'generate_landing_page', lambda idea, api_key=None: (None, "boom"))
+    for _ in range(5):
+        client.post('/api/generate/landing', json={"idea": "shop"}, headers=auth_headers)
+
+    monkeypatch.setattr(app_module, 'generate_landing_page', lambda idea, api_key=None: ("<html></html>", None))
+    codes = [client.post('/api/generate/landing', json={"idea": "shop"}, headers=auth_headers).status_code
+             for _ in range(4)]
+    assert codes == [200, 200, 200, 403]
+
+
+def test_reconciler_is_not_started_on_import(app_module):
+    assert 'credit-reconciler' not in [thread.name for thread in threading.enumerate()]
+
+
+def test_reconcile_credits_cli_runs_the_reconciler(app_module, monkeypatch):
+    calls = []
+    monkeypatch.setattr(app_module, 'run_credit_reconciler', lambda: calls.append(True))
+
+    result = app_module.app.test_cli_runner().invoke(args=['reconcile-credits'])
+
+    assert result.exit_code == 0
+    assert calls == [True]
@@ -0,0 +1,89 @@
+"""Storage backend: migrations and user/usage/purchase persistence."""
+
+import sqlite3
+
+from sqlalchemy import inspect, text
+from werkzeug.security import generate_password_hash
+
+from conftest import V0_SCHEMA, file_database_url
+
+
+def applied_versions(module):
+    with module.get_db() as conn:
+        return sorted(conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+
+def test_fresh_database_applies_all_migrations(app_module, app_context):
+    assert applied_versions(app_module) == [version for version, _ in app_module.MIGRATIONS]
+    tables = set(inspect(app_module.db.engine).get_table_names())
+    assert {'users', 'usage', 'transactions', 'schema_migrations'} <= tables
+
+
+def test_init_database_is_repeatable(app_module, app_context):
+    app_module.init_database()
+    assert applied_versions(app_module) == [version for version, _ in app_module.MIGRATIONS]
+
+
+def test_existing_v0_database_is_adopted(tmp_path, load_app):
+    (tmp_path / 'database').mkdir()
+    conn = sqlite3.connect(tmp_path / 'database' / 'users.db')
+    conn.executescript(V0_SCHEMA)
+    conn.execute(
+        "INSERT INTO users (email, password_hash, credits) VALUES (?, ?, ?)",
+        ("old@gmail.com", generate_password_hash("secret123"), 5)
+    )
+    conn.commit()
+    conn.close()
+
+    module = load_app(file_database_url(tmp_path))
+    with module.app.app_context():
+        assert applied_versions(module) == [version for version, _ in module.MIGRATIONS]
+        assert module.get_user_by_id(1)['credits'] == 5
+
+    response = module.app.test_client().post(
+        '/api/auth/login', json={"email": "old@gmail.com", "password": "secret123"}
+    )
+    assert response.status_code == 200
+    assert response.get_json()['user']['credits'] == 5
+
+
+def test_register_and_login(client):
+    credentials = {"email": "New@Gmail.com", "password": "secret123"}
+    assert client.post('/api/auth/register', json=credentials).status_code == 201
+    assert client.post('/api/auth/register', json=credentials).status_code == 400
+
+    response = client.post('/api/auth/login', json=credentials)
+    assert response.status_code == 200
+    assert response.get_json()['user']['email'] == "new@gmail.com"
+
+    wrong = client.post('/api/auth/login', json={**credentials, "password": "nope123"})
+    assert wrong.status_code == 401
+
+
+def test_get_user_by_id(app_module, auth_headers, app_context):
+    user = app_module.get_user_by_id("1")
+    assert user['email'] == "user@gmail.com"
+    assert user['credits'] == 0
+    assert app_module.get_user_by_id(999) is None
+
+
+def test_increment_usage_respects_limit(app_module, auth_headers, app_context):
+    assert [app_module.increment_usage("1", "image", 3) for _ in range(4)] == [True, True, True, False]
+    assert app_module.get_user_usage("1", "image") == 3
+    assert app_module.get_user_usage("1", "video") == 0
+
+
+def test_purchase_credits(app_module, client, auth_headers):
+    response = client.post('/api/credits/purchase', json={"package": "basic"}, headers=auth_headers)
+    assert response.status_code == 200
+    assert response.get_json()['credits'] == 1000
+
+    me = client.get('/api/auth/me', headers=auth_headers).get_json()
+    assert me['credits'] == 1000
+    assert me['is_premium'] is True
+
+    with app_module.app.app_context(), app_module.get_db() as conn:
+        rows = conn.execute(text("SELECT package, credits FROM transactions")).all()
+    assert [tuple(row) for row in rows] == [("basic", 1000)]
+
+    assert client.post('/api/credits/purchase', json={"package": "gold"}, headers=auth_headers).status_code == 400
@@ -0,0 +1,167 @@
+"""Idempotency-Key handling: replays, waiting retries, mismatches and expiry."""
+
+import io
+import os
+import threading
+
+import pytest
+from sqlalchemy import text
+
+from conftest import file_database_url
+
+PNG_BYTES = b'\x89PNG\r\n\x1a\nfake image'
+
+
+def purchase(client, headers, key, package="basic"):
+    return client.post('/api/credits/purchase', json={"package": package},
+                       headers=dict(headers, **{"Idempotency-Key": key}))
+
+
+def generate(client, headers, key, prompt="a cat"):
+    return client.post('/api/generate/image', json={"prompt": prompt},
+                       headers=dict(headers, **{"Idempotency-Key": key}))
+
+
+@pytest.fixture
+def upstream_calls(app_module, monkeypatch):
+    """Stub the image upstream and count how often it runs."""
+    calls = []
+
+    def generate_image(prompt, api_key=None):
+        calls.append(prompt)
+        return PNG_BYTES, None
+
+    monkeypatch.setattr(app_module, 'generate_image_gemini', generate_image)
+    return calls
+
+
+def key_count(module):
+    with module.app.app_context(), module.get_db() as conn:
+        return conn.execute(text("SELECT COUNT(*) FROM idempotency_keys")).scalar()
+
+
+def test_replayed_purchase_adds_credits_once(client, app_module, auth_headers):
+    first = purchase(client, auth_headers, "buy-1")
+    second = purchase(client, auth_headers, "buy-1")
+
+    assert first.status_code == second.status_code == 200
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert second.get_json() == first.get_json()
+    with app_module.app.app_context():
+        assert app_module.get_user_by_id(1)['credits'] == 1000
+
+
+def test_key_reused_for_different_request_is_rejected(client, auth_headers):
+    assert purchase(client, auth_headers, "buy-1").status_code == 200
+    assert purchase(client, auth_headers, "buy-1", package="pro").status_code == 422
+
+
+def test_key_released_when_request_fails(client, app_module, auth_headers, monkeypatch):
+    monkeypatch.setattr(app_module, 'generate_image_gemini', lambda prompt, api_key=None: (None, "upstream down"))
+
+    assert generate(client, auth_headers, "gen-1").status_code == 500
+    assert key_count(app_module) == 0
+
+
+def test_concurrent_retry_waits_for_original(tmp_path, load_app, monkeypatch):
+    # Concurrent requests need separate connections, so only the file database applies
+    module = load_app(file_database_url(tmp_path))
+    started, finish = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_generate(prompt, api_key=None):
+        calls.append(prompt)
+        started.set()
+        finish.wait(5)
+        return PNG_BYTES, None
+
+    monkeypatch.setattr(module, 'generate_image_gemini', slow_generate)
+    client = module.app.test_client()
+    credentials = {"email": "user@gmail.com", "password": "secret123"}
+    client.post('/api/auth/register', json=credentials)
+    token = client.post('/api/auth/login', json=credentials).get_json()['token']
+    headers = {"Authorization": f"Bearer {token}"}
+
+    responses = {}
+    original = threading.Thread(target=lambda: responses.update(original=generate(module.app.test_client(), headers, "gen-1")))
+    original.start()
+    assert started.wait(5)
+    retry = threading.Thread(target=lambda: responses.update(retry=generate(module.app.test_client(), headers, "gen-1")))
+    retry.start()
+    threading.Timer(0.3, finish.set).start()
+    original.join(10)
+    retry.join(10)
+
+    assert len(calls) == 1
+    assert responses['original'].status_code == responses['retry'].status_code == 200
+    assert responses['retry'].headers['Idempotent-Replayed'] == 'true'
+    assert responses['retry'].get_json()['image'] == responses['original'].get_json()['image']
+
+
+def test_replay_without_output_file_drops_inline_field(client, auth_headers, upstream_calls):
+    first = generate(client, auth_headers, "gen-1").get_json()
+    os.remove(os.path.join('outputs', first['filename']))
+
+    replay = generate(client, auth_headers, "gen-1")
+
+    assert replay.status_code == 200
+    assert replay.get_json() == {"filename": first['filename'], "variants": first['variants']}
+    assert len(upstream_calls) == 1
+
+
+def test_expired_keys_are_purged_and_can_be_reused(client, app_module, auth_headers, upstream_calls):
+    assert generate(client, auth_headers, "gen-1").status_code == 200
+    with app_module.app.app_context(), app_module.get_db() as conn:
+        conn.execute(text("UPDATE idempotency_keys SET expires_at = 0"))
+
+    # Before the background purge runs, an expired key is taken over like a fresh one
+    assert 'Idempotent-Replayed' not in generate(client, auth_headers, "gen-1").headers
+    assert len(upstream_calls) == 2
+
+    with app_module.app.app_context(), app_module.get_db() as conn:
+        conn.execute(text("UPDATE idempotency_keys SET expires_at = 0"))
+    with app_module.app.app_context():
+        assert app_module.purge_idempotency_keys() == 1
+    assert key_count(app_module) == 0
+
+
+def test_abandoned_in_progress_key_is_taken_over(client, app_module, auth_headers, upstream_calls):
+    with app_module.app.app_context(), app_module.get_db() as conn:
+        conn.execute(text('''
+            INSERT INTO idempotency_keys (user_id, idempotency_key, fingerprint, status, started_at, expires_at)
+            VALUES (1, 'gen-1', 'stale', 'in_progress', 0, 9999999999)
+        '''))
+
+    response = generate(client, auth_headers, "gen-1")
+
+    assert response.status_code == 200
+    assert len(upstream_calls) == 1
+
+
+def test_purchase_completes_key_with_the_grant(client, app_module, auth_headers, monkeypatch):
+    # Simulate the worker dying after the purchase transaction committed
+    def crash(user_id, key, response):
+        raise SystemExit("worker killed")
+
+    monkeypatch.setattr(app_module, 'complete_idempotency_key', crash)
+    first = purchase(client, auth_headers, "buy-1")
+    assert first.status_code == 200
+
+    with app_module.app.app_context(), app_module.get_db() as conn:
+        conn.execute(text("UPDATE idempotency_keys SET started_at = 0"))
+    retry = purchase(client, auth_headers, "buy-1")
+
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.get_json() == first.get_json()
+    with app_module.app.app_context():
+        assert app_module.get_user_by_id(1)['credits'] == 1000
+
+
+def test_fingerprint_covers_whole_upload(app_module):
+    big = os.urandom(200 * 1024)
+    fingerprints = set()
+    for data in (big, big[:-1] + b'\0', big):
+        with app_module.app.test_request_context('/api/tryon', method='POST', data={"person": (io.BytesIO(data), 'p.png')}):
+            fingerprints.add(app_module.request_fingerprint())
+            assert app_module.request.files['person'].read() == data
+    assert len(fingerprints) == 2
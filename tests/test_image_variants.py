@@ -0,0 +1,103 @@
+"""Image variants: Accept negotiation, resizing, passthrough and error cases."""
+
+import io
+import os
+
+import pytest
+from PIL import Image
+
+
+@pytest.fixture
+def output_image(app_module):
+    """Write a 2000x1000 PNG into outputs/ and return its filename."""
+    Image.new("RGB", (2000, 1000), "orange").save(os.path.join('outputs', 'sample.png'))
+    return 'sample.png'
+
+
+def served_format(response):
+    return Image.open(io.BytesIO(response.data)).format
+
+
+@pytest.mark.parametrize("accept, mimetype, pil_format", [
+    ("*/*", "image/png", "PNG"),
+    ("text/html,application/xhtml+xml,*/*;q=0.8", "image/png", "PNG"),
+    ("image/*", "image/png", "PNG"),
+    ("image/webp,*/*;q=0.8", "image/webp", "WEBP"),
+    ("image/avif,image/webp;q=0.9", "image/avif", "AVIF"),
+    ("image/png", "image/png", "PNG"),
+    ("image/png,image/webp;q=0.5", "image/png", "PNG"),
+    ("image/avif;q=0,image/webp", "image/webp", "WEBP"),
+    (None, "image/png", "PNG"),
+])
+def test_encoding_follows_explicit_accept(client, output_image, accept, mimetype, pil_format):
+    headers = {"Accept": accept} if accept else {}
+
+    response = client.get(f'/api/image/{output_image}/thumb', headers=headers)
+
+    assert response.status_code == 200
+    assert response.mimetype == mimetype
+    assert served_format(response) == pil_format
+    assert 'Accept' in response.headers['Vary']
+
+
+@pytest.mark.parametrize("variant, size", [("thumb", (256, 128)), ("preview", (1024, 512)), ("full", (2000, 1000))])
+def test_variant_dimensions(client, output_image, variant, size):
+    response = client.get(f'/api/image/{output_image}/{variant}', headers={"Accept": "image/webp"})
+
+    assert Image.open(io.BytesIO(response.data)).size == size
+
+
+def test_full_png_is_served_unchanged(client, output_image):
+    response = client.get(f'/api/image/{output_image}/full', headers={"Accept": "image/png"})
+
+    with open(os.path.join('outputs', output_image), 'rb') as f:
+        assert response.data == f.read()
+    assert not os.listdir(os.path.join('outputs', 'variants'))
+
+
+def test_download_variant_is_png_for_browsers(client, output_image):
+    response = client.get(f'/api/download/{output_image}?variant=preview',
+                          headers={"Accept": "text/html,application/xhtml+xml,*/*;q=0.8"})
+
+    assert response.status_code == 200
+    assert 'sample_preview.png' in response.headers['Content-Disposition']
+
+
+@pytest.mark.parametrize("path", [
+    '/api/image/sample.png/huge',
+    '/api/image/missing.png/thumb',
+    '/api/image/notes.txt/thumb',
+    '/api/download/sample.png?variant=huge',
+    '/api/download/missing.png?variant=thumb',
+])
+def test_unknown_variant_or_file_is_404(client, output_image, path):
+    response = client.get(path)
+
+    assert response.status_code == 404
+    assert response.is_json
+
+
+def test_undecodable_output_returns_json_error(client, app_module):
+    with open(os.path.join('outputs', 'bad.png'), 'wb') as f:
+        f.write(b'not an image at all')
+
+    response = client.get('/api/image/bad.png/thumb')
+
+    assert response.status_code == 415
+    assert response.get_json() == {"error": "Image could not be decoded"}
+    assert not os.listdir(os.path.join('outputs', 'variants'))
+
+
+def test_failed_encode_leaves_no_temp_file(client, app_module, output_image, monkeypatch):
+    def failing_save(self, fp, format=None, **params):
+        with open(fp, 'wb') as f:
+            f.write(b'partial')
+        raise OSError("disk full")
+
+    monkeypatch.setattr(Image.Image, 'save', failing_save)
+    app_module.app.testing = False
+
+    response = client.get(f'/api/image/{output_image}/thumb')
+
+    assert response.status_code == 500
+    assert not os.listdir(os.path.join('outputs', 'variants'))
@@ -0,0 +1,77 @@
+"""Fingerprinted static assets, the index page and API response compression."""
+
+import gzip
+import json
+import os
+import re
+
+import brotli
+import pytest
+
+
+def asset_urls(html):
+    return re.findall(r'(?:href|src)="(/(?:static|assets)/[^"]+)"', html)
+
+
+def test_index_references_hashed_assets(client, app_module):
+    response = client.get('/', headers={"Accept-Encoding": "identity"})
+    html = response.get_data(as_text=True)
+
+    assert sorted(asset_urls(html)) == sorted(app_module.ASSET_MANIFEST.values())
+    assert re.fullmatch(r'/assets/styles\.[0-9a-f]{12}\.css', app_module.ASSET_MANIFEST['styles.css'])
+    for url in app_module.ASSET_MANIFEST.values():
+        path = os.path.join('build', 'assets', url.rsplit('/', 1)[1])
+        assert os.path.isfile(path)
+        assert os.path.isfile(path + '.br') and os.path.isfile(path + '.gz')
+
+
+@pytest.mark.parametrize("accept_encoding, encoding, decompress", [
+    ("gzip, deflate, br", "br", brotli.decompress),
+    ("gzip", "gzip", gzip.decompress),
+    ("identity", None, lambda data: data),
+])
+def test_asset_encoding_and_caching(client, app_module, accept_encoding, encoding, decompress):
+    url = app_module.ASSET_MANIFEST['script.js']
+    with open(os.path.join('static', 'script.js'), 'rb') as f:
+        original = f.read()
+
+    response = client.get(url, headers={"Accept-Encoding": accept_encoding})
+
+    assert response.status_code == 200
+    assert response.content_encoding == encoding
+    assert decompress(response.data) == original
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == app_module.ASSET_MAX_AGE
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+
+def test_unknown_asset_is_404(client):
+    assert client.get('/assets/script.000000000000.js').status_code == 404
+
+
+@pytest.mark.parametrize("accept_encoding", ["br", "gzip", "identity"])
+def test_index_revalidates_with_etag(client, accept_encoding):
+    first = client.get('/', headers={"Accept-Encoding": accept_encoding})
+    assert first.cache_control.no_cache
+
+    second = client.get('/', headers={"Accept-Encoding": accept_encoding, "If-None-Match": first.headers['ETag']})
+
+    assert second.status_code == 304
+    assert not second.data
+
+
+def test_index_etag_differs_per_encoding(client):
+    etags = {client.get('/', headers={"Accept-Encoding": e}).headers['ETag'] for e in ("br", "gzip", "identity")}
+    assert len(etags) == 3
+
+
+@pytest.mark.parametrize("size, compressed", [(100, False), (20_000, True), (2_000_000, False)])
+def test_api_compression_size_bounds(client, app_module, monkeypatch, size, compressed):
+    packages = {"padding": "x" * size}
+    monkeypatch.setattr(app_module, 'CREDIT_PACKAGES', packages)
+
+    response = client.get('/api/credits/packages', headers={"Accept-Encoding": "gzip"})
+
+    assert response.content_encoding == ("gzip" if compressed else None)
+    body = gzip.decompress(response.data) if compressed else response.data
+    assert json.loads(body) == packages
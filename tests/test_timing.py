@@ -0,0 +1,70 @@
+"""Request timing: Server-Timing header and per-statement query timers."""
+
+import time
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from conftest import file_database_url
+
+
+def timing_names(response):
+    return [metric.split(';')[0] for metric in response.headers['Server-Timing'].split(', ')]
+
+
+def test_server_timing_only_exposes_total_by_default(client):
+    credentials = {"email": "user@gmail.com", "password": "secret123"}
+    client.post('/api/auth/register', json=credentials)
+
+    known = client.post('/api/auth/login', json=credentials)
+    unknown = client.post('/api/auth/login', json={"email": "nobody@gmail.com", "password": "secret123"})
+
+    assert known.status_code == 200
+    assert unknown.status_code == 401
+    assert timing_names(known) == timing_names(unknown) == ['total']
+
+
+def test_server_timing_detail_flag_exposes_spans(tmp_path, load_app):
+    module = load_app(file_database_url(tmp_path), SERVER_TIMING_DETAIL='1')
+    client = module.app.test_client()
+    credentials = {"email": "user@gmail.com", "password": "secret123"}
+    client.post('/api/auth/register', json=credentials)
+
+    names = timing_names(client.post('/api/auth/login', json=credentials))
+
+    assert 'db' in names
+    assert 'password_check' in names
+    assert names[-1] == 'total'
+
+
+def test_failed_statement_does_not_skew_later_query_timing(tmp_path, load_app, monkeypatch):
+    module = load_app(file_database_url(tmp_path), SERVER_TIMING_DETAIL='1')
+    db_spans = []
+    record_span = module.record_span
+
+    def capture_span(name, seconds):
+        if name == 'db':
+            db_spans.append(seconds)
+        record_span(name, seconds)
+
+    monkeypatch.setattr(module, 'record_span', capture_span)
+
+    def failing_then_working_queries():
+        with module.db.engine.connect() as conn:
+            with pytest.raises(OperationalError):
+                conn.execute(text("SELECT * FROM no_such_table"))
+            time.sleep(0.2)
+            conn.execute(text("SELECT 1"))
+            conn.execute(text("SELECT 2"))
+        return {"ok": True}
+
+    module.app.add_url_rule('/api/test/queries', view_func=failing_then_working_queries)
+    response = module.app.test_client().get('/api/test/queries')
+
+    assert response.status_code == 200
+    # Only the two successful statements are timed, and neither absorbs the sleep
+    assert len(db_spans) == 2
+    assert all(0 <= seconds < 0.2 for seconds in db_spans)
+    timings = dict(metric.split(';dur=') for metric in response.headers['Server-Timing'].split(', '))
+    assert 0 <= float(timings['db']) < 200